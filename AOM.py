@@ -20,7 +20,7 @@ class Piece(pzp.Piece):
         @ao_port.set_setter(self)
         @self._ensure_daq
         def ao_port(self, value):
-            if not self.puzzle.debug:
+            if not self._simulated():
                 self.puzzle["NIDAQ"].daq.add_voltage_output("AOM_mod_in", value.lower(), rng=(0, 5), initial_value=0.0)
             return value
 
@@ -28,7 +28,7 @@ class Piece(pzp.Piece):
         @pzp.param.spinbox(self, "mod_in", 0., v_min=0.0, v_max=5.0, v_step=0.5)
         @self._ensure_daq
         def mod_in(self, value):
-            if self.puzzle.debug:
+            if self._simulated():
                 return value
             # If we're connected and not in debug mode, set the mod_in voltage
             self.puzzle["NIDAQ"].daq.set_voltage_outputs("AOM_mod_in", value)
@@ -36,11 +36,17 @@ class Piece(pzp.Piece):
         @mod_in.set_getter(self)
         @self._ensure_daq
         def mod_in(self):
-            if self.puzzle.debug:
+            if self._simulated():
                 return self.params['mod_in'].value
             # If we're connected and not in debug mode, return the exposure from the camera
             return self.puzzle["NIDAQ"].daq.get_voltage_outputs("AOM_mod_in")[0]
 
+    # Debug mode without a (simulated) DAQ connected: only the GUI value is kept
+    def _simulated(self):
+        if not self.puzzle.debug:
+            return False
+        return "NIDAQ" not in self.puzzle.pieces or not hasattr(self.puzzle["NIDAQ"], "daq")
+
     # Ensure devices are connected
     @pzp.piece.ensurer        
     def _ensure_daq(self):
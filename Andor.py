@@ -8,6 +8,14 @@ import datetime
 import time
 import threading
 import sys
+import os
+import contextlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import camera_tools
+import display_tools
+from hardware import andor_sim
 
 
 def timeout_func(func, args=None, kwargs=None, timeout=30, default=None):
@@ -79,7 +87,10 @@ class Settings(pzp.piece.Popup):
 
         ### TO CLEAR - MIGHT NOT NEED DELAY
         self.add_child_params(["vs_speed", "input_port", "slit_width", "output_port", 
-                               "counts", "max_counts", "sub_background"])
+                               "counts", "max_counts", "sub_background",
+                               "ring depth", "fps", "dropped", "sum frames", "noise map", "flat correction",
+                               "background frames", "sigma clip", "wls cache", "settle timeout", "settle ms",
+                               "render budget", "render ms", "max display fps", "acquired fps", "displayed fps"])
         ###
         
         # Reload dropdown lists when Settings popup opened
@@ -105,18 +116,44 @@ class Settings(pzp.piece.Popup):
         relaod_dropdowns()
     
     def define_actions(self):
-        self.add_child_actions(["Take background", "ROI", "Export device info", "More settings"])
+        self.add_child_actions(["Take background", "Take flat field", "ROI", "Export device info", "More settings",
+                                "Clear wls cache"])
         return super().define_actions()
 
 
 class Base(pzp.Piece):
     def __init__(self, puzzle):
+        # Device settings read through the param values, see trust_cache - needed by define_params
+        self._params_cache = camera_tools.ParamCache()
         # Move the custom_layout to the right of the generated inputs
         super().__init__(puzzle, custom_horizontal=True)
         # self.image will store the image the camera takes
         self.image = np.zeros([256,1024])
         self.params["sub_background"].set_value(False)    
         self._acquiring = False
+        # Ring buffer and worker for the streaming mode
+        self._ring = camera_tools.FrameRing(self.params["ring depth"].value)
+        self._stream_worker = None
+        self._stream_pending = False
+        self._stream_skipped = 0
+        self._stream_stats_time = 0
+        # acquire_async requests run one after another on a single thread, so they complete in order
+        self._acq_executor = ThreadPoolExecutor(max_workers=1)
+        # Reused by accumulated acquisitions, which all run on that thread
+        self._accumulator = camera_tools.FrameAccumulator()
+        self._live_future = None
+        # Background and flat field correction, with the dark cast and flat gain cached
+        self._corrector = camera_tools.BackgroundCorrector()
+        self._background_stack = None
+        # (frame, spectrum) of the last published frame, see fvb_spectrum
+        self._fvb = (None, None)
+        # Setters wait for the live view and camera to go idle instead of sleeping a fixed time
+        self._settler = camera_tools.Settler()
+        self._trigger_worker = None
+        self._configuring = False
+        # Wavelength axes by grating, centre and detector pixels, kept between sessions
+        self._wls_cache = camera_tools.CalibrationCache(None if puzzle.debug else os.path.join(os.path.dirname(os.path.abspath(__file__)), "hardware", "andor_calibration.npz"))
+        self._pixel_info = None
 
     def define_params(self):
     
@@ -140,6 +177,7 @@ class Base(pzp.Piece):
         # Connect to device
         @pzp.param.checkbox(self, "connected", 0)
         def connect(self, value):
+            self._params_cache.invalidate()
             if self.puzzle.debug:
                 A = [(1,1,1), (2,2,2), (3,3,3)]
                 self["amp_mode"].input.clear()
@@ -232,6 +270,14 @@ class Base(pzp.Piece):
                 list = []
             return list
         
+        # Sensor temperature in °C, as a number for logging (see Logger)
+        @pzp.readout.define(self, "temperature", "{:.2f}", visible=False)
+        @self._ensure_connected
+        def temperature(self):
+            if not self.puzzle.debug:
+                return self.cam.get_temperature()
+            return -70.
+
         # Getter for camera temperature status
         @pzp.readout.define(self, "temp_status")
         @self._ensure_connected
@@ -256,9 +302,7 @@ class Base(pzp.Piece):
         def exposure(self, value):
             if self.puzzle.debug:
                 return value
-            if self.timer.input.isChecked():
-                self.call_stop()
-                time.sleep(1)
+            self._settle("exposure")
             if self.cam.acquisition_in_progress():
                 self.cam.stop_acquisition()
                 self.cam.set_exposure(value*1e-3)
@@ -267,14 +311,13 @@ class Base(pzp.Piece):
                 self.cam.set_exposure(value*1e-3)
 
         @exposure.set_getter(self)
+        @self._params_cache.read_through("exposure", self.params)
         @self._ensure_connected
         def exposure(self):
             if self.puzzle.debug:
                 return self.params['exposure'].value
             # If we're connected and not in debug mode, return the exposure from the camera
-            if self.timer.input.isChecked():
-                self.call_stop()
-                time.sleep(0.5)
+            self._settle("exposure")
             return self.cam.get_exposure()*1e3
 
 
@@ -285,13 +328,12 @@ class Base(pzp.Piece):
             return None
 
         @amp_mode.set_getter(self)
+        @self._params_cache.read_through("amp_mode", self.params)
         @self._ensure_connected
         def amp_mode(self):
             if self.puzzle.debug:
                 return self.params['amp_mode'].value
-            if self.timer.input.isChecked():
-                self.call_stop()
-                time.sleep(0.5)
+            self._settle("amp_mode")
             amp_mode_fun = self.cam.get_amp_mode()
             return f"{amp_mode_fun.hsspeed:1d}: {amp_mode_fun.hsspeed_MHz:.2f}MHz, {amp_mode_fun.preamp:1d}: {amp_mode_fun.preamp_gain:.1f}"
 
@@ -299,12 +341,11 @@ class Base(pzp.Piece):
         @self._ensure_connected
         def amp_mode(self, value):
             if not self.puzzle.debug:
-                if self.timer.input.isChecked():
-                    self.call_stop()
-                    time.sleep(0.5)
+                self._settle("amp_mode")
                 amp_value = value
                 amp_input = [ int(amp_value.split(":")[0]), int(amp_value.split(":")[1].split(",")[1]) ]
                 self.cam.set_amp_mode(0, 0, *amp_input)
+            self._params_cache.validate("amp_mode")
             return value
 
         # Set VS speed mode (vertical shift speed)
@@ -313,6 +354,7 @@ class Base(pzp.Piece):
             return None
 
         @vs_speed.set_getter(self)
+        @self._params_cache.read_through("vs_speed", self.params)
         @self._ensure_connected
         def vs_speed(self):
             if self.puzzle.debug:
@@ -324,11 +366,10 @@ class Base(pzp.Piece):
         @self._ensure_connected
         def vs_speed(self, value):
             if not self.puzzle.debug:
-                if self.timer.input.isChecked():
-                    self.call_stop()
-                    time.sleep(0.5)
+                self._settle("vs_speed")
                 idx = np.argmin(np.abs(np.array(self.params['vs_speed_list_getter'].value) - float(value)))
                 self.cam.set_vsspeed(idx)
+            self._params_cache.validate("vs_speed")
             return value
 
         # Setup ROI
@@ -337,6 +378,7 @@ class Base(pzp.Piece):
             return None
             
         @roi.set_getter(self)
+        @self._params_cache.read_through("roi", self.params)
         def roi(self):
             if not self.puzzle.debug and self.params["connected"].value:
                 return self.cam.get_roi()[:4]
@@ -345,19 +387,23 @@ class Base(pzp.Piece):
         @roi.set_setter(self)
         def roi(self, value):
             if not self.puzzle.debug and self.params["connected"].value:
-                if self.timer.input.isChecked():
-                    self.call_stop()
-                    time.sleep(0.5)
+                self._settle("roi")
                 roi_for_camInput = [ int(v) for v in value]
                 self.cam.set_roi(*roi_for_camInput, 1, 1)
             self.params["sub_background"].set_value(False)
+            self._params_cache.validate("roi")
             return value
 
         # Image getter
         @pzp.param.array(self, 'image')
         @self._ensure_connected
         def image(self):                   
-            if self.puzzle.debug:
+            if self.params["Stream"].value:
+                # Newest frame from the ring buffer, no acquisition of its own
+                self.image = self._ring.latest()
+                if self.image is None:
+                    raise Exception("No frame streamed yet")
+            elif self.puzzle.debug:
                 # If we're in debug mode, we just return random noise
                 dummy_imgsize = self.params["roi"].get_value()
                 self.image = np.random.random((dummy_imgsize[3]-dummy_imgsize[2]+1, dummy_imgsize[1]-dummy_imgsize[0]+1))*1024
@@ -369,9 +415,10 @@ class Base(pzp.Piece):
                 else:
                     self.image = self.cam.snap()
             if self.params['sub_background'].get_value():
-                self.image = self.image.astype(np.int32) - self.params['background'].get_value().astype(np.int32)
+                self.image = self._subtract_background(self.image)
             if self.image.shape[1] != self.params["wls"].value.shape[0]:
                 self.params["wls"].get_value()
+            self._fvb = (self.image, self.image.sum(axis=0))
             return self.image
 
         # Toggle background subtraction
@@ -386,6 +433,20 @@ class Base(pzp.Piece):
             return self.params["sub_background"].value
         
         pzp.param.array(self, 'background', False)(None)
+        # Frames combined into the background, rejecting cosmic rays with a per-pixel median
+        # or, with "sigma clip", a sigma-clipped mean. Their per-pixel spread goes to "background noise".
+        pzp.param.spinbox(self, "background frames", 1, v_min=1, visible=False)(None)
+        pzp.param.checkbox(self, "sigma clip", False, visible=False)(None)
+        pzp.param.array(self, 'background noise', False)(None)
+
+        # Flat field correction on top of the background subtraction, see "Take flat field"
+        @pzp.param.checkbox(self, 'flat correction', False, visible=False)
+        def flat_correction(self, value):
+            if value and self.params["flat field"].value is None:
+                raise Exception("Flat field is not taken")
+            return value
+
+        pzp.param.array(self, 'flat field', False)(None)
 
         # Readout for total counts
         @pzp.param.readout(self, 'counts', False)
@@ -405,13 +466,12 @@ class Base(pzp.Piece):
             return None
         
         @grating.set_getter(self)
+        @self._params_cache.read_through("grating", self.params)
         @self._ensure_connected
         def grating(self):
             if self.puzzle.debug:
                 return self.params['grating'].value
-            if self.timer.input.isChecked():
-                self.call_stop()
-                time.sleep(0.5)
+            self._settle("grating")
             grat_idx = self.spec.get_grating()
             grat_info = self.spec.get_grating_info(grat_idx)
             return f"{grat_idx:02d} - {int(grat_info.lines)} lpmm, {grat_info.blaze_wavelength}"
@@ -420,12 +480,14 @@ class Base(pzp.Piece):
         @self._ensure_connected
         def grating(self, value:str):
             if not self.puzzle.debug:
-                if self.timer.input.isChecked():
-                    self.call_stop()
-                    time.sleep(1)
+                self._settle("grating")
                 grat_idx = int(value.split(" - ")[0])
                 self.spec.set_grating(grat_idx)
-                self.params["wls"].get_value()
+                # The spectrograph may move the centre wavelength for the new grating
+                self._params_cache.invalidate("centre")
+                if not self._configuring:
+                    self.params["wls"].get_value()
+            self._params_cache.validate("grating")
             return value
         
         self.params["grating"].input.setMinimumWidth(160)
@@ -441,9 +503,11 @@ class Base(pzp.Piece):
                 self.spec.goto_zero_order()
             else:
                 self.spec.set_wavelength(value*1e-9)
-            self.params["wls"].get_value()
+            if not self._configuring:
+                self.params["wls"].get_value()
 
         @centre.set_getter(self)
+        @self._params_cache.read_through("centre", self.params)
         @self._ensure_connected
         def centre(self):
             if self.puzzle.debug:
@@ -456,20 +520,39 @@ class Base(pzp.Piece):
         # Get wavelength calibration
         @pzp.param.array(self, 'wls', True)
         def wls(self):
-            roi = self.params["roi"].get_value()
+            with self.trust_cache():
+                roi = self.params["roi"].get_value()
             if not self.puzzle.debug:
                 try:
-                    if self.params["centre"].get_value() == 0:
+                    with self.trust_cache():
+                        centre = self.params["centre"].get_value()
+                    if centre == 0:
                         return np.linspace(0, roi[1]-roi[0], roi[1]-roi[0])
-                    self.spec.setup_pixels_from_camera(self.cam)
-                    return self.spec.get_calibration()[roi[0]:roi[1]]*1e9
+                    # The full-detector calibration only depends on these, the ROI just slices it
+                    if self._pixel_info is None:
+                        self._pixel_info = (self.cam.get_detector_size()[0], self.cam.get_pixel_size()[0])
+                    # The grating getter stops the live view, so only its stored value is used here
+                    grat_idx = int(self.params["grating"].value.split(" - ")[0]) if self.cache_covers(["grating"]) else self.spec.get_grating()
+                    key = (grat_idx, round(centre, 3), *self._pixel_info)
+                    calibration = self._wls_cache.get(key, self._read_calibration)
+                    return calibration[roi[0]:roi[1]]*1e9
                 except:
                     return np.linspace(0, 100, roi[1]-roi[0]+1)
+                finally:
+                    self.params["wls cache"].get_value()
             # return np.linspace(roi[0], roi[1], (roi[1]-roi[0]+1))*3
-            return np.linspace(300, 700, roi[1]-roi[0]+1)
+            key = (self.params["grating"].value, round(self.params["centre"].value or 0, 3), roi[1]-roi[0]+1)
+            calibration = self._wls_cache.get(key, lambda: np.linspace(300, 700, roi[1]-roi[0]+1))
+            self.params["wls cache"].get_value()
+            return calibration.copy()
 
         self.params["wls"].set_value(np.linspace(0, 1024, 1024))
 
+        # Wavelength calibration cache statistics
+        @pzp.param.readout(self, "wls cache", False)
+        def wls_cache(self):
+            return self._wls_cache.stats()
+
         # Toggle between image & full-vertical binning mode
         @pzp.param.checkbox(self, 'FVB mode', False)
         def fvb_mode(self, value):
@@ -488,21 +571,67 @@ class Base(pzp.Piece):
         # Toggle between internal and external trigger mode
         @pzp.param.checkbox(self, 'External trigger', False)
         def ext_trigger_mode(self, value):
-            if not self.puzzle.debug:
-                current_value = self.params['External trigger'].value
-                if value and not current_value:
-                    self.cam.clear_acquisition()
-                    self.cam.set_acquisition_mode("cont")
-                    self.cam.set_trigger_mode("ext")
-                    self.cam.start_acquisition()
-                    return 1
-                elif current_value and not value:
-                    self.cam.stop_acquisition()
-                    self.cam.clear_acquisition()
-                    self.cam.set_acquisition_mode("single")
-                    self.cam.set_trigger_mode("int")
+            if value and self.params["Stream"].value:
+                self.params["Stream"].set_value(False)
+            # In debug mode this configures the simulated camera
+            cam = self._camera()
+            current_value = self.params['External trigger'].value
+            if value and not current_value:
+                cam.clear_acquisition()
+                cam.set_acquisition_mode("cont")
+                cam.set_trigger_mode("ext")
+                cam.start_acquisition()
+                return 1
+            elif current_value and not value:
+                cam.stop_acquisition()
+                cam.clear_acquisition()
+                cam.set_acquisition_mode("single")
+                cam.set_trigger_mode("int")
 
-                    return 0
+                return 0
+
+        # Toggle streaming: continuous acquisition drained into a ring buffer on a worker thread
+        @pzp.param.checkbox(self, "Stream", False)
+        @self._ensure_connected
+        def stream(self, value):
+            current_value = self.params["Stream"].value
+            if value and not current_value:
+                if self["External trigger"].value:
+                    raise Exception("Streaming only available in internal trigger mode")
+                self.start_stream()
+                return 1
+            elif current_value and not value:
+                self.stop_stream()
+                return 0
+
+        # Number of frames held in the streaming ring buffer
+        pzp.param.spinbox(self, "ring depth", 16, v_min=2, visible=False)(None)
+
+        # Achieved streaming frame rate
+        @pzp.param.readout(self, "fps", False, "{:.1f}")
+        def fps(self):
+            return self._ring.fps()
+
+        # Frames lost by the camera buffer since streaming started
+        @pzp.param.readout(self, "dropped", False)
+        def dropped(self):
+            return self._ring.dropped
+
+        # Longest wait (s) for the camera to go idle before changing a setting
+        pzp.param.spinbox(self, "settle timeout", 10., v_min=0.1, visible=False)(None)
+
+        # How long the last setting change waited for the camera
+        @pzp.param.readout(self, "settle ms", False, "{:.1f}")
+        def settle_ms(self):
+            return self._settler.last * 1e3
+
+        # Frames combined into each image by get_image and the live view
+        pzp.param.spinbox(self, "accumulate N", 1, v_min=1)(None)
+        # Sum the accumulated frames rather than averaging them
+        pzp.param.checkbox(self, "sum frames", False, visible=False)(None)
+        # Keep a running per-pixel variance while accumulating, published as the "noise" standard deviation
+        pzp.param.checkbox(self, "noise map", False, visible=False)(None)
+        pzp.param.array(self, "noise", False)(None)
 
         # Set input port
         @pzp.param.dropdown(self, "input_port", "", visible=False)
@@ -519,9 +648,7 @@ class Base(pzp.Piece):
         @input_port.set_setter(self)
         @self._ensure_connected
         def input_port(self, value):
-            if self.timer.input.isChecked():
-                self.call_stop()
-                time.sleep(0.5)
+            self._settle("input_port")
             if not self.puzzle.debug:
                 self.spec.set_flipper_port("input", value)
             return value
@@ -539,6 +666,7 @@ class Base(pzp.Piece):
                 raise e
 
         @slit_width.set_getter(self)
+        @self._params_cache.read_through("slit_width", self.params)
         @self._ensure_connected
         def slit_width(self):
             if self.timer.input.isChecked():
@@ -563,9 +691,7 @@ class Base(pzp.Piece):
         @output_port.set_setter(self)
         @self._ensure_connected
         def output_port(self, value):
-            if self.timer.input.isChecked():
-                self.call_stop()
-                time.sleep(0.5)
+            self._settle("output_port")
             if not self.puzzle.debug:
                 self.spec.set_flipper_port("output", value)
             return value
@@ -605,12 +731,16 @@ class Base(pzp.Piece):
 
         @pzp.action.define(self, "Take background", visible=False)
         def take_background(self):
+            self.acquire_background()
+
+        # Uniformly illuminated frame, used with the background to even out the pixel response
+        @pzp.action.define(self, "Take flat field", visible=False)
+        def take_flat_field(self):
+            self._ensure_background_exist()
             self.params['sub_background'].set_value(False)
-            # Maybe we should take a more proper background? Instead of just setting AOM to zero volt
-            self.puzzle["AOM"]["mod_in"].set_value(0)
-            background = self.get_image(signal_delay = 50, timeout_ms=5000)
-            self.params['background'].set_value(background)
+            self.params['flat field'].set_value(self.get_image(timeout_ms=5000))
             self.params['sub_background'].set_value(True)
+            self.params['flat correction'].set_value(True)
 
         @pzp.action.define(self, "Settings")
         @self._ensure_connected
@@ -624,6 +754,14 @@ class Base(pzp.Piece):
                 raise Exception("More setting only avaliable in internal trigger mode")
             self.open_popup(More_Settings, "More settings")
 
+        # Forget the stored wavelength axes, after recalibrating the spectrograph
+        @pzp.action.define(self, "Clear wls cache", visible=False)
+        def clear_wls_cache(self):
+            self._wls_cache.clear()
+            self.params["wls cache"].get_value()
+            if self.params["connected"].value:
+                self.params["wls"].get_value()
+
         @pzp.action.define(self, "Export device info", visible=False)
         def export_device_info(self, filename=None):
             info_dict = None
@@ -716,11 +854,16 @@ class Base(pzp.Piece):
 
     def dispose(self):
         # This function 'disposes' of the camera, effectively disconnecting us
+        if self._stream_worker is not None:
+            # The setter stops the stream
+            self.params["Stream"].set_value(False)
         if hasattr(self, 'cam'):
             self.cam.close()
             self.spec.close()
             del self.cam
             del self.spec
+            self._pixel_info = None
+            self._params_cache.invalidate()
 
     # Disconnect the camera when window close
     def handle_close(self, event):
@@ -748,6 +891,13 @@ class Base(pzp.Piece):
         do not start another acquisition until the previous worker finishes.
         """
 
+        if self["Stream"].value:
+            return None    # Frames arrive from the stream worker
+        if self["accumulate N"].value > 1:
+            # Accumulate on the acquisition thread, skipping ticks while the previous image is in progress
+            if self._live_future is None or self._live_future.done():
+                self._live_future = self._submit_acquisition(self["accumulate N"].value, 5, True)
+            return None
         if not self["External trigger"].value:
             if not self.puzzle.debug:
                 self.image = self.cam.snap()
@@ -764,6 +914,7 @@ class Base(pzp.Piece):
             # Build and start your acquisition worker
             worker = pzp.threads.Worker(self.acquire_frame_worker, kwargs={"timeout": 5})
             worker.returned.connect(self._on_frame_ready)
+            self._trigger_worker = worker
 
             self.puzzle.run_worker(worker)
         return None   # Timer expects a return but acquisition is async
@@ -772,33 +923,385 @@ class Base(pzp.Piece):
         self.image = frame
         self._acquiring = False
         if self.params['sub_background'].get_value():
-            self.image = self.image.astype(np.int32) - self.params['background'].get_value().astype(np.int32)
+            self.image = self._subtract_background(self.image)
         if self.image.shape[1] != self.params["wls"].value.shape[0]:
             self.params["wls"].get_value()
+        self._fvb = (self.image, self.image.sum(axis=0))
         self["image"].set_value(self.image)
 
-    def get_image(self, signal_delay = 50, timeout_ms=5000):
-        loop = QtCore.QEventLoop()
-        frame_acquired = False
-
-        def done():
-            nonlocal frame_acquired
-            frame_acquired = True
-            loop.quit()
-
-        self.params["image"].changed.connect(done)
-        QtCore.QTimer.singleShot(0, self.trigger_acquisition)
-        if self["External trigger"].value:
-            QtCore.QTimer.singleShot(signal_delay, self.puzzle["Spot trigger"].actions["Send pulse train"])
-        QtCore.QTimer.singleShot(timeout_ms, loop.quit)
-        loop.exec()
-        
-        # Check if frame was acquired
-        if not frame_acquired:
-            raise Exception(f"No frame received within {timeout_ms} ms")
+    def fvb_spectrum(self, image):
+        # Sum over rows, reusing the one computed where the frame was published
+        frame, spectrum = self._fvb
+        if frame is image:
+            return spectrum
+        return image.sum(axis=0)
+
+    def _subtract_background(self, image):
+        flat = self.params['flat field'].value if self.params['flat correction'].value else None
+        return self._corrector.apply(image, self.params['background'].value, flat)
+
+    def acquire_background(self, accumulate=None):
+        self.params['sub_background'].set_value(False)
+        # Maybe we should take a more proper background? Instead of just setting AOM to zero volt
+        self.puzzle["AOM"]["mod_in"].set_value(0)
+        m = self.params["background frames"].value
+        if m > 1:
+            frames = [self.get_image(timeout_ms=5000, accumulate=accumulate) for i in range(m)]
+            if self._background_stack is None or self._background_stack.shape != (m, *frames[0].shape) \
+                    or self._background_stack.dtype != frames[0].dtype:
+                self._background_stack = np.empty((m, *frames[0].shape), frames[0].dtype)
+            np.stack(frames, out=self._background_stack)
+            method = "sigma clip" if self.params["sigma clip"].value else "median"
+            background, noise = camera_tools.robust_background(self._background_stack, method)
+            self.params['background noise'].set_value(noise)
+        else:
+            background = self.get_image(timeout_ms=5000, accumulate=accumulate)
+        self.params['background'].set_value(background)
+        self.params['sub_background'].set_value(True)
+        return background
+
+    # Camera used by the acquisition engines - the simulated camera stands in for the SDK in debug mode
+    def _camera(self):
+        if self.puzzle.debug:
+            if not hasattr(self, "_sim_cam"):
+                self._sim_cam = andor_sim.SimAndorCamera(exposure=self.params["exposure"].value*1e-3)
+            # Follow the ROI and readout mode set in the GUI
+            roi = self.params["roi"].value
+            rows = 1 if self.params["FVB mode"].value else roi[3]-roi[2]+1
+            if self._sim_cam.shape != (rows, roi[1]-roi[0]+1):
+                self._sim_cam.set_shape((rows, roi[1]-roi[0]+1))
+            return self._sim_cam
+        return self.cam
+
+    def start_stream(self):
+        self._settle("start_stream")
+        cam = self._camera()
+        if self.puzzle.debug:
+            cam.set_exposure(self.params["exposure"].value*1e-3)
+        # Continuous mode runs the detector at its kinetic rate without per-frame setup
+        cam.clear_acquisition()
+        cam.set_acquisition_mode("cont")
+        cam.start_acquisition()
+
+        self._ring = camera_tools.FrameRing(self.params["ring depth"].value)
+        self._stream_pending = False
+        self._stream_skipped = 0
+        self._stream_worker = pzp.threads.LiveWorker(self._drain_stream, sleep=0)
+        self._stream_worker.returned.connect(self._on_stream_frame)
+        self.puzzle.run_worker(self._stream_worker)
+
+    def stop_stream(self):
+        if self._stream_worker is not None:
+            self._stream_worker.stop()
+            # The worker returns within one frame wait
+            t_end = time.perf_counter() + 2
+            while not self._stream_worker.done and time.perf_counter() < t_end:
+                time.sleep(0.01)
+            self._stream_worker = None
+        cam = self._camera()
+        cam.stop_acquisition()
+        cam.clear_acquisition()
+        cam.set_acquisition_mode("single")
+        self["fps"].get_value()
+        self["dropped"].get_value()
+
+    # Stream worker: move all new frames from the camera into the ring buffer
+    def _drain_stream(self):
+        cam = self._camera()
+        try:
+            if not cam.wait_for_frame(timeout=0.5):
+                return None
+        except cam.TimeoutError:
+            return None
+        frames = cam.read_multiple_images()
+        if not frames:
+            return None
+        skipped = cam.get_frames_status().skipped
+        for frame in frames[:-1]:
+            self._ring.push(frame)
+        self._ring.push(frames[-1], dropped=skipped - self._stream_skipped)
+        self._stream_skipped = skipped
+        # Only signal the GUI once it has handled the previous frame - it always shows the newest one
+        if self._stream_pending:
+            return None
+        self._stream_pending = True
+        return True
+
+    def _on_stream_frame(self, ready):
+        if ready is None:
+            return
+        self._stream_pending = False
+        frame = self._ring.latest()
+        if frame is not None:
+            self._on_frame_ready(frame)
+        if time.perf_counter() - self._stream_stats_time > 0.5:
+            self._stream_stats_time = time.perf_counter()
+            self["fps"].get_value()
+            self["dropped"].get_value()
+
+    def acquire_async(self, n_frames=1, timeout=5, accumulate=False):
+        """
+        Acquire `n_frames` frames on a worker thread without blocking or re-entering the
+        Qt event loop. In external trigger mode each frame is triggered with the
+        "Spot trigger" pulse train.
+
+        Returns a `concurrent.futures.Future` that resolves to the list of frames. The
+        last frame is also published to the `image` param, like a live view frame.
+        Requests are queued, so several can be in flight and complete in order.
+        The future also carries `triggered`, a `threading.Event` set once the last pulse
+        train has gone out, and `timestamps`, the arrival time of each frame.
+
+        With `accumulate`, the frames are added up in place as they arrive instead of being
+        kept, and the list holds the single combined image - see :func:`combine_frames`.
+        """
+        if self.timer.input.isChecked():
+            self.call_stop()
+        return self._submit_acquisition(n_frames, timeout, accumulate)
+
+    def _submit_acquisition(self, n_frames, timeout, accumulate):
+        triggered = threading.Event()
+        timestamps = []
+        future = self._acq_executor.submit(self._acquire_frames, int(n_frames), timeout, triggered, timestamps, accumulate)
+        future.triggered = triggered
+        future.timestamps = timestamps
+        return future
+
+    # acquire_async worker
+    def _acquire_frames(self, n_frames, timeout, triggered, timestamps, accumulate=False):
+        try:
+            cam = self._camera()
+            frames = []
+            if accumulate:
+                self._reset_accumulator()
+            # Accumulated frames go straight into the accumulator, so the ring buffer slot needs no copy
+            keep = self._accumulator.add if accumulate else frames.append
+            if self["Stream"].value:
+                # Take the next n frames landing in the ring buffer, each one in turn
+                ring = self._ring
+                start = ring.frames
+                t_end = time.perf_counter() + timeout*n_frames
+                overwritten = "Streamed frames were written over before they were read, increase \"ring depth\""
+                while len(timestamps) < n_frames:
+                    index = start + len(timestamps)
+                    try:
+                        streamed = ring.get(index)
+                    except IndexError:
+                        raise Exception(overwritten)
+                    if streamed is None:
+                        if time.perf_counter() > t_end:
+                            raise Exception(f"No frame streamed within {timeout} s")
+                        time.sleep(1e-3)
+                        continue
+                    frame, t = streamed
+                    keep(frame if accumulate else frame.copy())
+                    if not ring.holds(index):
+                        raise Exception(overwritten)
+                    timestamps.append(t)
+            elif self["External trigger"].value:
+                # Discard stale frames so that each wait counts from its own trigger
+                cam.read_multiple_images()
+                for i in range(n_frames):
+                    self._fire_trigger()
+                    if i == n_frames - 1:
+                        triggered.set()
+                    try:
+                        cam.wait_for_frame(timeout=timeout)
+                    except cam.TimeoutError:
+                        raise Exception(f"No frame received within {timeout} s")
+                    keep(cam.read_newest_image())
+                    timestamps.append(time.perf_counter())
+            else:
+                for i in range(n_frames):
+                    keep(cam.snap(timeout=timeout))
+                    timestamps.append(time.perf_counter())
+            if accumulate:
+                frames = [self._accumulated_image(self._accumulator)]
+            self._on_frame_ready(frames[-1])
+            return frames
+        finally:
+            triggered.set()
+
+    def _live_idle(self):
+        for worker in (self.timer.worker, self._trigger_worker):
+            if worker is not None and not worker.done:
+                return False
+        if self._live_future is not None and not self._live_future.done():
+            return False
+        # Snaps leave the camera idle, triggered and streamed acquisitions keep it running
+        if self["External trigger"].value or self["Stream"].value:
+            return True
+        if self.puzzle.debug:
+            return not hasattr(self, "_sim_cam") or not self._sim_cam.acquisition_in_progress()
+        return not self.cam.acquisition_in_progress()
+
+    def _settle(self, label):
+        # Stop the live view and wait for the frame in progress to finish
+        if self._configuring:
+            return    # configure() has already done this
+        if self.timer.input.isChecked():
+            self.call_stop()
+        self._settler.wait(self._live_idle, label, self.params["settle timeout"].value)
+        self["settle ms"].get_value()
+
+    def _read_calibration(self):
+        # Full-detector wavelength axis in m, for the current grating and centre
+        self.spec.setup_pixels_from_camera(self.cam)
+        return self.spec.get_calibration()
+
+    def _reset_accumulator(self):
+        if self._accumulator.variance != bool(self["noise map"].value):
+            self._accumulator = camera_tools.FrameAccumulator(variance=bool(self["noise map"].value))
+        self._accumulator.reset()
+
+    def _accumulated_image(self, acc):
+        if acc.variance:
+            self["noise"].set_value(np.sqrt(acc.var()))
+        # Copied out, as the accumulator buffers are reused by the next acquisition
+        return np.array(acc.sum() if self["sum frames"].value else acc.mean())
+
+    def combine_frames(self, frames):
+        """
+        Combine already acquired frames the way accumulated acquisitions do: summed if
+        "sum frames" is set, averaged otherwise.
+        """
+        acc = camera_tools.FrameAccumulator(variance=bool(self["noise map"].value))
+        for frame in frames:
+            acc.add(frame)
+        return self._accumulated_image(acc)
 
+    def acquire_kinetic(self, n_frames, timeout=5):
+        """
+        Arm an externally triggered kinetic series of `n_frames` frames, for scans where the
+        trigger pulses are generated by hardware. Returns a future like :func:`acquire_async`,
+        whose `timestamps` grow as frames arrive. Set `future.abort` to give up early.
+        The camera is back in continuous external trigger mode once the future resolves.
+        """
+        if not self["External trigger"].value:
+            raise Exception("Kinetic series need external trigger mode")
+        if self.timer.input.isChecked():
+            self.call_stop()
+        cam = self._camera()
+        cam.clear_acquisition()
+        cam.setup_acquisition("kinetic", int(n_frames))
+        cam.start_acquisition()
+        abort = threading.Event()
+        timestamps = []
+        future = self._acq_executor.submit(self._acquire_kinetic, int(n_frames), timeout, abort, timestamps)
+        future.abort = abort
+        future.timestamps = timestamps
+        return future
+
+    # acquire_kinetic worker
+    def _acquire_kinetic(self, n_frames, timeout, abort, timestamps):
+        cam = self._camera()
+        frames = []
+        try:
+            while len(frames) < n_frames and not abort.is_set():
+                try:
+                    # The first frame waits for the trigger train to start
+                    if cam.wait_for_frame(timeout=timeout) is False:
+                        break
+                except cam.TimeoutError:
+                    raise Exception(f"No frame received within {timeout} s")
+                new = cam.read_multiple_images() or []
+                frames.extend(new)
+                timestamps.extend([time.perf_counter()] * len(new))
+            if frames:
+                self._on_frame_ready(frames[-1])
+            return frames
+        finally:
+            cam.stop_acquisition()
+            cam.clear_acquisition()
+            cam.set_acquisition_mode("cont")
+            cam.start_acquisition()
+
+    # Stand-in for the trigger cable in debug mode: deliver n pulses to the simulated camera
+    def sim_trigger(self, n=1, interval=0.):
+        self._camera().trigger(n, interval)
+
+    # Fire the pulse train for one externally triggered frame, returning once it has gone out
+    def _fire_trigger(self):
+        spot = self.puzzle["Spot trigger"]
+        spot.actions["Send pulse train"]()
+        if self.puzzle.debug:
+            # No trigger line in debug mode - deliver the pulse to the simulated camera directly
+            self.sim_trigger()
+        if spot["Rep rate"].value:
+            time.sleep(spot["pulses"].value / (spot["Rep rate"].value*1e3))
+
+    def get_image(self, signal_delay=None, timeout_ms=5000, accumulate=None):
+        # Returns once the frame is in, without a nested event loop or per-call signal connections.
+        # On the GUI thread, events are processed while waiting so the window stays responsive.
+        # `accumulate` frames are combined into the image, by default "accumulate N".
+        # `signal_delay` is ignored, the pulse train now goes out as soon as the camera is waiting.
+        if signal_delay is not None:
+            warnings.warn("get_image no longer uses signal_delay", DeprecationWarning, stacklevel=2)
+        n = self["accumulate N"].value if accumulate is None else accumulate
+        future = self.acquire_async(n, timeout=timeout_ms*1e-3, accumulate=n > 1)
+        if QtCore.QThread.currentThread() == QtWidgets.QApplication.instance().thread():
+            while not future.done():
+                self.puzzle.process_events()
+                time.sleep(1e-3)
+        future.result()
         return self.params["image"].value
-        
+
+    def trust_cache(self):
+        """
+        Within ``with andor.trust_cache():``, getters of settings that have been read or set since
+        connecting return the stored value without querying the camera or stopping the live view.
+        """
+        return self._params_cache.trusted()
+
+    # True if reading all `names` under trust_cache needs no SDK calls
+    def cache_covers(self, names):
+        return self._params_cache.covers(names)
+
+    # Order in which configure() applies settings: readout before timing, grating before centre
+    CONFIGURE_ORDER = ["FVB mode", "roi", "amp_mode", "vs_speed", "exposure",
+                       "input_port", "output_port", "slit_width", "grating", "centre"]
+    # Settings that move the wavelength axis, the ROI is picked up by the next image
+    WLS_SETTINGS = {"grating", "centre"}
+
+    @contextlib.contextmanager
+    def configure(self, settings=None):
+        """
+        Change several settings with a single stop of the live view::
+
+            with andor.configure() as config:
+                config["grating"] = "02 - 300 lpmm, 1200nm"
+                config["centre"] = 750
+                config["exposure"] = 50
+
+        The settings are applied when the block exits, only those that differ from the current
+        values, in :attr:`CONFIGURE_ORDER` and in internal trigger mode. The wavelength axis is
+        recalculated once at the end, and the trigger mode and live view are then restored.
+        """
+        pending = dict(settings or {})
+        yield pending
+        changed = {name: value for name, value in pending.items() if not np.array_equal(self.params[name].value, value)}
+        if not changed:
+            return
+        live = self.timer.input.isChecked()
+        trigger_mode = changed.pop("External trigger", self.params["External trigger"].value)
+        self._settle("configure")
+        try:
+            if changed and self.params["External trigger"].value:
+                self.params["External trigger"].set_value(False)
+            self._configuring = True
+            order = self.CONFIGURE_ORDER
+            for name in sorted(changed, key=lambda name: order.index(name) if name in order else len(order)):
+                self.params[name].set_value(changed[name])
+        finally:
+            self._configuring = False
+            if self.WLS_SETTINGS & changed.keys():
+                self.params["wls"].get_value()
+            if self.params["External trigger"].value != trigger_mode:
+                self.params["External trigger"].set_value(trigger_mode)
+            if live:
+                # Let the stopped live worker's done signal through first, or it would stop the new one
+                self.puzzle.process_events()
+                self.timer.input.setChecked(True)
+
     # define wrapper for changing setting in internal trigger mode
     def set_in_internal(self, func):
         def wrapper():
@@ -897,6 +1400,26 @@ class Piece(Base):
         
         pzp.param.spinbox(self, 'circle_r', 50, visible=False)(None)
 
+        # Time per displayed frame above which the image is shown at a lower resolution
+        pzp.param.spinbox(self, "render budget", 10., v_min=1., visible=False)(None)
+
+        # Time the last display update took, and the pixel blocks it was reduced by
+        @pzp.param.readout(self, "render ms", False, "{:.1f}")
+        def render_ms(self):
+            return self._decimator.last * 1e3
+
+        # Live view redraws are capped at this rate, frames in between are only counted
+        pzp.param.spinbox(self, "max display fps", 30., v_min=1., visible=False)(None)
+
+        # Rate of frames reaching the image param, and of them being drawn
+        @pzp.param.readout(self, "acquired fps", False, "{:.1f}")
+        def acquired_fps(self):
+            return self._display.acquisition_fps()
+
+        @pzp.param.readout(self, "displayed fps", False, "{:.1f}")
+        def displayed_fps(self):
+            return self._display.display_fps()
+
     def define_actions(self):
         super().define_actions()
 
@@ -929,13 +1452,7 @@ class Piece(Base):
         plot_fvb = self.gl.addPlot(1, 0)
 
         def px2wl_mapping():
-            image_min = self.params["roi"].value[0]
-            image_max = self.params["roi"].value[1] + 1
-            wl_min = self.params["wls"].value[0]
-            wl_max = self.params["wls"].value[-1]
-            m = (wl_max - wl_min) / (image_max - image_min)
-            c = wl_min
-            return m ,c
+            return self._render_geometry()[1:]
 
         def sync_plot_fvb(vb):
             main_xrange = vb.viewRange()[0]  # [min, max] from plot_main
@@ -988,29 +1505,33 @@ class Piece(Base):
         plot_main.addItem(self._circle)
 
         plot_line_fvb = plot_fvb.plot([0], [0])
+        plot_fvb.setDownsampling(auto=True, mode="peak")
+        plot_fvb.setClipToView(True)
 
+        self._setup_render()
 
         def update_image():
+            t_start = time.perf_counter()
             image_data = self.params['image'].value
-            self.imgw.setImage(image_data, autoLevels=self["autolevel"].value)
+            self._render_image(image_data)
             r = self.params['circle_r'].value
 
-            roi = self.params["roi"].get_value()
-            self._inf_line_x.setBounds([0, roi[3]-roi[2]])
-            self._inf_line_y.setBounds([0, roi[1]-roi[0]])
-
             self._circle.setRect(self._inf_line_y.value()-r,
                                 self._inf_line_x.value()-r,
                                 r*2, r*2)
 
-            plot_line_fvb.setData(self.params["wls"].value, image_data.sum(axis=0))
+            # A frame from before an ROI change can still be queued for display
+            if len(self.params["wls"].value) == image_data.shape[1]:
+                plot_line_fvb.setData(self.params["wls"].value, self.fvb_spectrum(image_data))
             m, c = px2wl_mapping()
             self._inf_line_fvb.setPos([x*m+c for x in self._inf_line_y.getPos()])
+            self._render_done(t_start)
              
-        update_later = pzp.threads.CallLater(update_image)
-        self.params['image'].changed.connect(update_later)
-        self._inf_line_x.sigPositionChanged.connect(update_later)
-        self._inf_line_y.sigPositionChanged.connect(update_later)
+        self._display = display_tools.DisplayScheduler.for_puzzle(self.puzzle).register(
+            update_image, lambda: self["max display fps"].value, self._render_stats)
+        self.params['image'].changed.connect(self._display.frame)
+        self._inf_line_x.sigPositionChanged.connect(self._display.request)
+        self._inf_line_y.sigPositionChanged.connect(self._display.request)
 
         plot_main.sigXRangeChanged.connect(sync_plot_fvb)
         plot_fvb.sigXRangeChanged.connect(sync_plot_main)
@@ -1032,8 +1553,58 @@ class Piece(Base):
         self.timer.input.checkStateChanged.connect(disable_ext_trigger)
         self.timer.input.checkStateChanged.connect(reset_acquiring)
 
+        # Live view is fed by the stream worker while streaming
+        def disable_live():
+            self.timer.input.setEnabled(not self["Stream"].value)
+
+        self.params["Stream"].changed.connect(disable_live)
+
 
         return layout
+
+    ### Render stage, shared by the live view layouts ###
+    def _setup_render(self):
+        # Needs self.imgw and the crosshair lines
+        self._decimator = camera_tools.DisplayDecimator(self["render budget"].value*1e-3)
+        self._geometry = None
+        self._image_rect = None
+        def invalidate_geometry():
+            self._geometry = None
+        self.params["roi"].changed.connect(invalidate_geometry)
+        self.params["wls"].changed.connect(invalidate_geometry)
+
+    def _render_geometry(self):
+        # ROI, crosshair bounds and pixel to wavelength mapping, kept until the ROI or wavelength axis change
+        if self._geometry is None:
+            roi = self.params["roi"].value
+            wls = self.params["wls"].value
+            self._inf_line_x.setBounds([0, roi[3]-roi[2]])
+            self._inf_line_y.setBounds([0, roi[1]-roi[0]])
+            m = (wls[-1] - wls[0]) / (roi[1] + 1 - roi[0])
+            self._geometry = (roi, m, wls[0])
+        return self._geometry
+
+    def _render_image(self, image):
+        # Show the frame at about the screen resolution, keeping full-frame pixel coordinates
+        self._render_geometry()
+        pixel_size = self.imgw.getViewBox().viewPixelSize()
+        reduced = self._decimator.reduce(image, pixel_size[::-1])
+        if self["autolevel"].value:
+            self.imgw.setImage(reduced, autoLevels=False, levels=[reduced.min(), reduced.max()])
+        else:
+            self.imgw.setImage(reduced, autoLevels=False)
+        if self._image_rect != (image.shape, reduced.shape):
+            self._image_rect = (image.shape, reduced.shape)
+            self.imgw.setRect(QtCore.QRectF(0, 0, image.shape[1], image.shape[0]))
+
+    def _render_done(self, t_start):
+        self._decimator.budget = self["render budget"].value*1e-3
+        self._decimator.record(time.perf_counter() - t_start)
+
+    def _render_stats(self):
+        self["render ms"].get_value()
+        self["acquired fps"].get_value()
+        self["displayed fps"].get_value()
     
     def call_stop(self):
         self.timer.stop()
@@ -1072,13 +1643,7 @@ class LineoutPiece(Piece):
         plot_fvb = self.gl.addPlot(2, 0)
 
         def px2wl_mapping():
-            image_min = self.params["roi"].value[0]
-            image_max = self.params["roi"].value[1] + 1
-            wl_min = self.params["wls"].value[0]
-            wl_max = self.params["wls"].value[-1]
-            m = (wl_max - wl_min) / (image_max - image_min)
-            c = wl_min
-            return m ,c
+            return self._render_geometry()[1:]
 
         def sync_plot_fvb(vb):
             main_xrange = vb.viewRange()[0]  # [min, max] from plot_main
@@ -1134,17 +1699,17 @@ class LineoutPiece(Piece):
         plot_line_x = plot_x.plot([0], [0])
         plot_line_y = plot_y.plot([0], [0])
         plot_line_fvb = plot_fvb.plot([0], [0])
+        plot_fvb.setDownsampling(auto=True, mode="peak")
+        plot_fvb.setClipToView(True)
 
+        self._setup_render()
 
         def update_image():
+            t_start = time.perf_counter()
             image_data = self.params['image'].value
-            self.imgw.setImage(image_data, autoLevels=self["autolevel"].value)
+            self._render_image(image_data)
             r = self.params['circle_r'].value
 
-            roi = self.params["roi"].get_value()
-            self._inf_line_x.setBounds([0, roi[3]-roi[2]])
-            self._inf_line_y.setBounds([0, roi[1]-roi[0]])
-
             self._circle.setRect(self._inf_line_y.value()-r,
                                 self._inf_line_x.value()-r,
                                 r*2, r*2)
@@ -1155,14 +1720,18 @@ class LineoutPiece(Piece):
             except IndexError:
                 raise Exception("Crosshair out-of-range")
 
-            plot_line_fvb.setData(self.params["wls"].value, image_data.sum(axis=0))
+            # A frame from before an ROI change can still be queued for display
+            if len(self.params["wls"].value) == image_data.shape[1]:
+                plot_line_fvb.setData(self.params["wls"].value, self.fvb_spectrum(image_data))
             m, c = px2wl_mapping()
             self._inf_line_fvb.setPos([x*m+c for x in self._inf_line_y.getPos()])
+            self._render_done(t_start)
              
-        update_later = pzp.threads.CallLater(update_image)
-        self.params['image'].changed.connect(update_later)
-        self._inf_line_x.sigPositionChanged.connect(update_later)
-        self._inf_line_y.sigPositionChanged.connect(update_later)
+        self._display = display_tools.DisplayScheduler.for_puzzle(self.puzzle).register(
+            update_image, lambda: self["max display fps"].value, self._render_stats)
+        self.params['image'].changed.connect(self._display.frame)
+        self._inf_line_x.sigPositionChanged.connect(self._display.request)
+        self._inf_line_y.sigPositionChanged.connect(self._display.request)
 
         plot_main.sigXRangeChanged.connect(sync_plot_fvb)
         plot_fvb.sigXRangeChanged.connect(sync_plot_main)
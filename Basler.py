@@ -3,24 +3,62 @@ import pyqtgraph as pg
 from pyqtgraph.Qt import QtWidgets, QtCore
 import numpy as np
 import os, sys
+import contextlib
 import time
 from PIL import Image
 
+import camera_tools
+import display_tools
+
+def gige_link_fps(payload, packet_size, packet_delay=0., bandwidth=125e6):
+    """
+    Highest frame rate a GigE Vision link can carry for frames of `payload` bytes, sent in
+    packets of `packet_size` bytes with `packet_delay` seconds between them, on a link of
+    `bandwidth` bytes per second.
+    """
+    # Each packet spends 36 bytes on IP/UDP/GVSP headers and 38 on Ethernet framing
+    packets = np.ceil(payload / (packet_size - 36))
+    return 1 / ((payload + packets * 74) / bandwidth + packets * packet_delay)
+
 class Settings(pzp.piece.Popup):
     def define_params(self):
-        self.add_child_params(("armed", "Time Base", "black", "counts", "max_counts", "sub_background"))
+        self.add_child_params(("armed", "Time Base", "black", "counts", "max_counts", "sub_background", "flat correction", "settle ms",
+                               "max display fps", "acquired fps", "displayed fps",
+                               "stream trigger", "ring depth", "fps", "dropped", "throughput",
+                               "target fps", "resulting fps", "binning", "packet size", "max packet size", "min roi"))
+        self["stream trigger"].input.addItems(["Free run", "Line1"])
         return super().define_params()
     
     def define_actions(self):
-        self.add_child_actions(("Take background", "ROI", "Rediscover"))
+        self.add_child_actions(("Take background", "Take flat field", "ROI", "Rediscover"))
         return super().define_actions()
 
 class Base(pzp.Piece):
+    # Sensor size (width, height) and row readout time of the simulated camera in debug mode,
+    # matching the 640x480 defaults in the .pfs settings files
+    DEBUG_SENSOR = (640, 480)
+    DEBUG_LINE_TIME = 15e-6
+
     def __init__(self, puzzle):
+        # Camera settings read through the param values, see trust_cache - needed by define_params
+        self._params_cache = camera_tools.ParamCache()
         # Move the custom_layout to the right of the generated inputs
         super().__init__(puzzle, custom_horizontal=True)
         # self.image will store the image the camera takes
         self.image = None
+        # Background and flat field correction, with the dark cast and flat gain cached
+        self._corrector = camera_tools.BackgroundCorrector()
+        # Setters wait for the live view to finish its frame instead of sleeping a fixed time
+        self._settler = camera_tools.Settler()
+        # Streaming: a grab thread copies frames into a pool of reused buffers, see start_stream
+        self._ring = camera_tools.FrameRing(self.params["ring depth"].value)
+        self._stream_worker = None
+        self._stream_pending = False
+        self._stream_stats_time = 0
+        self._last_block = None
+        self._stream_lost = 0
+        # Beam centroid and width on every frame, see Beam_Popup
+        self._profiler = camera_tools.BeamProfiler()
 
     def define_params(self):
         # Make a parameter for the serial number of the camera
@@ -41,6 +79,7 @@ class Base(pzp.Piece):
         # the function below - if checked, the function gets value=1, otherwise 0
         @pzp.param.checkbox(self, "connected", 0)
         def connect(self, value):
+            self._params_cache.invalidate()
             if self.puzzle.debug:
                 # Do nothing if we're in debug mode
                 return 1
@@ -53,7 +92,7 @@ class Base(pzp.Piece):
                     cam_index = [i.GetModelName() for i in self.cam_list].index(self['serial'].value)
                     self.camera = self.imports.InstantCamera(self.tlf.CreateDevice(self.cam_list[cam_index]))
                     self.camera.Open()
-                    self.camera.GevSCPSPacketSize.Value = 1500
+                    self.camera.GevSCPSPacketSize.Value = self.params["max packet size"].value
                     self.camera.AcquisitionMode.Value = "Continuous"
                     self.camera.TriggerControlImplementation.Value = "Standard"
 
@@ -89,10 +128,8 @@ class Base(pzp.Piece):
                 self.camera.StartGrabbing(self.imports.GrabStrategy_LatestImageOnly)
                 return 1
             elif not value and current_value:
-                if self.timer.input.isChecked():
-                    self.call_stop()
-                    time.sleep(0.5)
-                self.camera.StopGrabbing()
+                with self._settle("armed"):
+                    self.camera.StopGrabbing()
                 return 0
             return current_value
         
@@ -109,6 +146,7 @@ class Base(pzp.Piece):
             
 
         @exposure_tbase.set_getter(self)
+        @self._params_cache.read_through("Time Base", self.params)
         @self._ensure_connected
         def exposure_tbase(self):
             if self.puzzle.debug:
@@ -135,6 +173,7 @@ class Base(pzp.Piece):
         # so here we register a 'getter' for the exposure param - a function
         # called to see what the current exposure value is.
         @exposure.set_getter(self)
+        @self._params_cache.read_through("exposure", self.params)
         @self._ensure_connected
         def get_exposure(self):
             if self.puzzle.debug:
@@ -150,6 +189,7 @@ class Base(pzp.Piece):
             self.camera.GainRaw.Value = value
 
         @gain.set_getter(self)
+        @self._params_cache.read_through("gain", self.params)
         @self._ensure_connected
         def gain(self):
             if self.puzzle.debug:
@@ -179,6 +219,7 @@ class Base(pzp.Piece):
             return None
             
         @roi.set_getter(self)
+        @self._params_cache.read_through("roi", self.params)
         def roi(self):
             if not self.puzzle.debug and self.params["connected"].value:
                 WHXY = [self.camera.Width.Value,
@@ -191,25 +232,23 @@ class Base(pzp.Piece):
         @roi.set_setter(self)
         def roi(self, value):
             if not self.puzzle.debug and self.params["connected"].value:
-                if self.timer.input.isChecked():
-                    self.call_stop()
-                    time.sleep(0.5)
-
-                WHXY = self.roi2WHXY(value)
-                print(WHXY)
-                try:
-                    self.camera.OffsetX.Value = WHXY[2]
-                    self.camera.Width.Value = WHXY[0]
-                except:
-                    self.camera.Width.Value = WHXY[0]
-                    self.camera.OffsetX.Value = WHXY[2]
-                try:
-                    self.camera.OffsetY.Value = WHXY[3]
-                    self.camera.Height.Value = WHXY[1]
-                except:
-                    self.camera.Height.Value = WHXY[1]
-                    self.camera.OffsetY.Value = WHXY[3]
+                with self._settle("roi"):
+                    WHXY = self.roi2WHXY(value)
+                    print(WHXY)
+                    try:
+                        self.camera.OffsetX.Value = WHXY[2]
+                        self.camera.Width.Value = WHXY[0]
+                    except:
+                        self.camera.Width.Value = WHXY[0]
+                        self.camera.OffsetX.Value = WHXY[2]
+                    try:
+                        self.camera.OffsetY.Value = WHXY[3]
+                        self.camera.Height.Value = WHXY[1]
+                    except:
+                        self.camera.Height.Value = WHXY[1]
+                        self.camera.OffsetY.Value = WHXY[3]
             self.params["sub_background"].set_value(False)
+            self._params_cache.validate("roi")
             return value
 
         
@@ -218,10 +257,15 @@ class Base(pzp.Piece):
         @self._ensure_connected
         @self._ensure_armed
         def get_image(self):
-            if self.puzzle.debug:
+            if self.params["Stream"].value:
+                # Newest frame from the buffer pool, no acquisition of its own
+                image = self._ring.latest()
+                if image is None:
+                    raise Exception("No frame streamed yet")
+            elif self.puzzle.debug:
                 # If we're in debug mode, we just return random noise
                 dummy_imgsize = self.params["roi"].get_value()
-                image = np.random.random((dummy_imgsize[3]-dummy_imgsize[2]+1, dummy_imgsize[1]-dummy_imgsize[0]+1))*1024
+                image = np.random.random((dummy_imgsize[3]-dummy_imgsize[1], dummy_imgsize[2]-dummy_imgsize[0]))*1024
             else:
                 # Send software trigger, then retrieve the frame within timeout
                 self.camera.ExecuteSoftwareTrigger()
@@ -229,8 +273,12 @@ class Base(pzp.Piece):
                 image = res.Array
                 if image is None:
                     raise Exception('Acquisition did not complete within the timeout...')
+            if self.params["beam analysis"].value and not self.params["Stream"].value:
+                # Streamed frames are measured as they are grabbed
+                self._profiler.measure(image)
             if self.params['sub_background'].get_value():
-                image = image.astype(np.int32) - self.params['background'].get_value().astype(np.int32)
+                flat = self.params['flat field'].value if self.params['flat correction'].value else None
+                image = self._corrector.apply(image, self.params['background'].value, flat)
             return image
             
         @pzp.param.readout(self, 'counts', False)
@@ -246,6 +294,141 @@ class Base(pzp.Piece):
         pzp.param.checkbox(self, 'sub_background', 0, visible=False)(None)
         pzp.param.array(self, 'background', False)(None)
 
+        # Flat field correction on top of the background subtraction, see "Take flat field"
+        @pzp.param.checkbox(self, 'flat correction', 0, visible=False)
+        def flat_correction(self, value):
+            if value and self.params["flat field"].value is None:
+                raise Exception("Flat field is not taken")
+            return value
+
+        pzp.param.array(self, 'flat field', False)(None)
+
+        # Toggle streaming: free-running or hardware-triggered grabbing on a worker thread
+        @pzp.param.checkbox(self, "Stream", False)
+        @self._ensure_connected
+        def stream(self, value):
+            current_value = self.params["Stream"].value
+            if value and not current_value:
+                self.start_stream()
+                return 1
+            elif current_value and not value:
+                self.stop_stream()
+                return 0
+
+        # What starts each frame while streaming: the camera's own frame rate or a pulse on Line1
+        pzp.param.dropdown(self, "stream trigger", "Free run", visible=False)(None)
+
+        # Number of frame buffers in the pool (and in the pylon grab engine)
+        pzp.param.spinbox(self, "ring depth", 16, v_min=2, visible=False)(None)
+
+        # Achieved streaming frame rate
+        @pzp.param.readout(self, "fps", False, "{:.1f}")
+        def fps(self):
+            return self._ring.fps()
+
+        # Frames lost by the camera or the grab engine since streaming started
+        @pzp.param.readout(self, "dropped", False)
+        def dropped(self):
+            return self._ring.dropped + self._stream_lost
+
+        # Streamed data rate in MB/s
+        @pzp.param.readout(self, "throughput", False, "{:.1f}")
+        def throughput(self):
+            frame = self._ring.latest()
+            if frame is None:
+                return 0.
+            return self._ring.fps() * frame.nbytes / 1e6
+
+        # Pick the ROI, binning and packet size that reach this frame rate, see fit_fps
+        @pzp.param.spinbox(self, "target fps", 0., v_min=0., visible=False)
+        @self._ensure_connected
+        def target_fps(self, value):
+            if value:
+                self.fit_fps(value)
+            return value
+
+        # Frame rate the camera runs at with the current settings, sensor or link limited
+        @pzp.param.readout(self, "resulting fps", False, "{:.1f}")
+        @self._ensure_connected
+        def resulting_fps(self):
+            if self.puzzle.debug:
+                roi = self.params["roi"].value
+                rows = roi[3] - roi[1]
+                payload = rows * (roi[2] - roi[0])
+                sensor_fps = 1 / (self.params["exposure"].value * 1e-3 + rows * self.DEBUG_LINE_TIME)
+                delay = 0
+            else:
+                sensor_fps = self.camera.ResultingFrameRateAbs.Value
+                payload = self.camera.PayloadSize.Value
+                delay = self.camera.GevSCPD.Value / self.camera.GevTimestampTickFrequency.Value
+            return min(sensor_fps, gige_link_fps(payload, self.params["packet size"].get_value(), delay))
+
+        # Binning factor, applied to both axes. The ROI is in binned pixels
+        @pzp.param.spinbox(self, "binning", 1, v_min=1, v_max=4, visible=False)
+        @self._ensure_connected
+        @self._ensure_disarmed
+        def binning(self, value):
+            if self.puzzle.debug:
+                return value
+            with self._settle("binning"):
+                self.camera.BinningHorizontal.Value = value
+                self.camera.BinningVertical.Value = value
+            self._params_cache.invalidate("roi")
+            self.params["sub_background"].set_value(False)
+
+        @binning.set_getter(self)
+        @self._ensure_connected
+        def binning(self):
+            if self.puzzle.debug:
+                return self.params["binning"].value or 1
+            return self.camera.BinningHorizontal.Value
+
+        # GigE stream packet size in bytes, larger packets carry less header overhead
+        @pzp.param.spinbox(self, "packet size", 1500, v_min=576, v_max=9000, visible=False)
+        @self._ensure_connected
+        @self._ensure_disarmed
+        def packet_size(self, value):
+            if self.puzzle.debug:
+                return value
+            with self._settle("packet size"):
+                self.camera.GevSCPSPacketSize.Value = value
+
+        @packet_size.set_getter(self)
+        @self._ensure_connected
+        def packet_size(self):
+            if self.puzzle.debug:
+                # Connecting sets the largest packet size, as on the camera
+                return self.params["packet size"].value or self.params["max packet size"].value
+            return self.camera.GevSCPSPacketSize.Value
+
+        # Largest packet the network adapter accepts - raise to 9000 if jumbo frames are enabled
+        pzp.param.spinbox(self, "max packet size", 1500, v_min=576, v_max=9000, visible=False)(None)
+
+        # fit_fps does not shrink the ROI below this many (binned) pixels on either side
+        pzp.param.spinbox(self, "min roi", 32, v_min=4, visible=False)(None)
+
+        # Measure the beam on every frame, see Beam_Popup
+        @pzp.param.checkbox(self, "beam analysis", 0, visible=False)
+        def beam_analysis(self, value):
+            if value and not self.params["beam analysis"].value:
+                self._profiler.reset()
+            return value
+
+        # Latest beam measurement in pixels
+        for name, field, fmt in (("beam x", "x", "{:.1f}"), ("beam y", "y", "{:.1f}"),
+                                 ("D4σ x", "d4s_x", "{:.1f}"), ("D4σ y", "d4s_y", "{:.1f}"),
+                                 ("ellipticity", "ellipticity", "{:.3f}"),
+                                 ("peak x", "peak_x", "{:.0f}"), ("peak y", "peak_y", "{:.0f}")):
+            def beam_value(self, field=field):
+                last = self._profiler.last
+                return np.nan if last is None else last[field]
+            pzp.param.readout(self, name, False, fmt)(beam_value)
+
+        # How long the last setting change waited for the live view
+        @pzp.param.readout(self, "settle ms", False, "{:.1f}")
+        def settle_ms(self):
+            return self._settler.last * 1e3
+
     def define_actions(self):
         @pzp.action.define(self, 'Take background', visible=False)
         def take_background(self):
@@ -253,6 +436,17 @@ class Base(pzp.Piece):
             background = self.params['image'].get_value()
             self.params['background'].set_value(background)
 
+        # Uniformly illuminated frame, used with the background to even out the pixel response
+        @pzp.action.define(self, 'Take flat field', visible=False)
+        def take_flat_field(self):
+            if self.params['background'].value is None:
+                raise Exception("Background is not taken")
+            sub_background = self.params['sub_background'].value
+            self.params['sub_background'].set_value(False)
+            self.params['flat field'].set_value(self.params['image'].get_value())
+            self.params['sub_background'].set_value(sub_background)
+            self.params['flat correction'].set_value(True)
+
         @pzp.action.define(self, "ROI", visible=False)
         @self._ensure_connected
         def roi(self):
@@ -290,6 +484,10 @@ class Base(pzp.Piece):
         def settings(self):
             self.open_popup(Settings, "Camera settings")
 
+        @pzp.action.define(self, "Beam")
+        def beam(self):
+            self.open_popup(Beam_Popup, "Beam analysis")
+
     @pzp.piece.ensurer
     def _ensure_connected(self):
         if not self.puzzle.debug and not self.params['connected'].value:
@@ -297,7 +495,7 @@ class Base(pzp.Piece):
         
     @pzp.piece.ensurer
     def _ensure_armed(self):
-        if not self.params['armed'].value:
+        if not self.params['armed'].value and not self.params['Stream'].value:
             self.params['armed'].set_value(1)
     
     @pzp.piece.ensurer
@@ -305,6 +503,193 @@ class Base(pzp.Piece):
         if self.params['armed'].value:
             self.params['armed'].set_value(0)
 
+    def trust_cache(self):
+        """
+        Within ``with basler.trust_cache():``, getters of settings that have been read or set since
+        connecting return the stored value without querying the camera.
+        """
+        return self._params_cache.trusted()
+
+    @contextlib.contextmanager
+    def _settle(self, label):
+        # Stop the live view and wait until its current RetrieveResult has returned, then
+        # reconfigure within the block
+        streaming = self.params["Stream"].value
+        if streaming:
+            # The camera can't be reconfigured while grabbing
+            self.params["Stream"].set_value(False)
+        if self.timer.input.isChecked():
+            self.call_stop()
+        self._settler.wait(lambda: self.timer.worker is None or self.timer.worker.done, label)
+        self["settle ms"].get_value()
+        yield
+        # Streaming carries on with the new setting
+        if streaming:
+            self.params["Stream"].set_value(True)
+
+    def fit_fps(self, target):
+        """
+        Reach at least `target` frames per second for streaming. The largest packet size
+        allowed is used first, then the ROI is shrunk around its current centre, at the
+        lowest binning that gets there. The ROI is found by bisection on the camera's own
+        resulting frame rate (limited by the link bandwidth), so it stays as large as the
+        target allows. Returns the achieved rate, which is below `target` if even the
+        smallest ROI at the highest binning is too slow.
+        """
+        exposure = self.params["exposure"].get_value()
+        if 1e3 / exposure < target:
+            raise Exception(f"The {exposure:.2f} ms exposure limits the frame rate to {1e3/exposure:.1f} fps")
+        self.params["armed"].set_value(0)
+        with self.trust_cache():
+            roi = self.params["roi"].get_value()
+        binning = self.params["binning"].get_value()
+        # Current ROI centre and size in sensor pixels
+        cx, cy = (roi[0] + roi[2]) / 2 * binning, (roi[1] + roi[3]) / 2 * binning
+        width, height = (roi[2] - roi[0]) * binning, (roi[3] - roi[1]) * binning
+
+        if self.puzzle.debug:
+            max_packet, max_binning = self.params["max packet size"].value, 4
+        else:
+            max_packet = min(self.params["max packet size"].value, self.camera.GevSCPSPacketSize.GetMax())
+            max_binning = min(self.camera.BinningHorizontal.GetMax(), self.camera.BinningVertical.GetMax())
+        self.params["packet size"].set_value(max_packet)
+
+        def reaches(fraction):
+            self._set_roi_around(cx, cy, width * fraction, height * fraction, binning)
+            return self.params["resulting fps"].get_value() >= target
+
+        binning = 1
+        while True:
+            self.params["binning"].set_value(binning)
+            if reaches(1.):
+                break
+            smallest = min(1., self.params["min roi"].value * binning / min(width, height))
+            if reaches(smallest):
+                low, high = smallest, 1.
+                for i in range(8):
+                    middle = (low + high) / 2
+                    if reaches(middle):
+                        low = middle
+                    else:
+                        high = middle
+                reaches(low)
+                break
+            if binning * 2 > max_binning:
+                break
+            binning *= 2
+        return self.params["resulting fps"].get_value()
+
+    def _set_roi_around(self, cx, cy, width, height, binning):
+        # Set the ROI closest to the given centre and size (sensor pixels), in steps the camera accepts
+        if self.puzzle.debug:
+            sensor, step = self.DEBUG_SENSOR, 1
+        else:
+            sensor = (self.camera.SensorWidth.Value, self.camera.SensorHeight.Value)
+            step = max(self.camera.Width.GetInc(), self.camera.OffsetX.GetInc(),
+                       self.camera.Height.GetInc(), self.camera.OffsetY.GetInc())
+        roi = []
+        for centre, size, full in ((cx, width, sensor[0]), (cy, height, sensor[1])):
+            full = full // binning // step * step
+            size = int(np.clip(np.round(size / binning / step) * step, step, full))
+            offset = int(np.clip(np.round((centre / binning - size / 2) / step) * step, 0, full - size))
+            roi.append((offset, offset + size))
+        self.params["roi"].set_value([roi[0][0], roi[1][0], roi[0][1], roi[1][1]])
+
+    def start_stream(self):
+        """
+        Grab continuously on a worker thread. Each frame is copied into the next buffer of a
+        preallocated pool (:class:`camera_tools.FrameRing`) and the newest one is published
+        to the image param, so the GUI never waits for the camera.
+
+        With ``PYLON_CAMEMU`` set (see :func:`setup`), the pylon camera emulator provides
+        a free-running test source.
+        """
+        self.params["armed"].set_value(0)
+        depth = self.params["ring depth"].value
+        self._ring = camera_tools.FrameRing(depth)
+        self._stream_pending = False
+        self._last_block = None
+        self._stream_lost = 0
+        if self.puzzle.debug:
+            roi = self.params["roi"].get_value()
+            self._sim_frames = np.random.random((4, roi[3]-roi[1], roi[2]-roi[0]))*1024
+            self._sim_period = 1 / self.params["resulting fps"].get_value()
+        else:
+            self.camera.TriggerSelector.Value = "FrameStart"
+            if self.params["stream trigger"].value == "Free run":
+                self.camera.TriggerMode.Value = "Off"
+            else:
+                self.camera.TriggerSource.Value = self.params["stream trigger"].value
+                self.camera.TriggerActivation.Value = "RisingEdge"
+            # Grab every frame in order; when the pool is full the camera drops frames,
+            # which shows up as gaps in the block IDs
+            self.camera.MaxNumBuffer.Value = depth
+            self.camera.StartGrabbing(self.imports.GrabStrategy_OneByOne)
+        self._stream_worker = pzp.threads.LiveWorker(self._grab_stream, sleep=0)
+        self._stream_worker.returned.connect(self._on_stream_frame)
+        self.puzzle.run_worker(self._stream_worker)
+
+    def stop_stream(self):
+        if self._stream_worker is not None:
+            self._stream_worker.stop()
+            # The worker returns within one RetrieveResult timeout
+            self._settler.wait(lambda: self._stream_worker.done, "stop_stream", 2.)
+            self._stream_worker = None
+        if not self.puzzle.debug:
+            self.camera.StopGrabbing()
+            # Back to software triggering for the live view
+            self.camera.TriggerSelector.Value = "FrameStart"
+            self.camera.TriggerMode.Value = "On"
+            self.camera.TriggerSource.Value = "Software"
+        self["fps"].get_value()
+        self["dropped"].get_value()
+        self["throughput"].get_value()
+
+    # Stream worker: copy the next frame from the grab engine into the buffer pool
+    def _grab_stream(self):
+        if self.puzzle.debug:
+            time.sleep(self._sim_period)
+            frame = self._ring.push(self._sim_frames[self._ring.frames % len(self._sim_frames)])
+        else:
+            res = self.camera.RetrieveResult(500, self.imports.TimeoutHandling_Return)
+            if not res.IsValid():
+                # Timed out, e.g. waiting for a hardware trigger
+                return None
+            try:
+                if not res.GrabSucceeded():
+                    self._stream_lost += 1
+                    return None
+                block = res.BlockID
+                dropped = 0
+                if self._last_block is not None and block > self._last_block + 1:
+                    dropped = block - self._last_block - 1
+                self._last_block = block
+                # Copy straight out of the pylon buffer so it can be requeued immediately
+                with res.GetArrayZeroCopy() as array:
+                    frame = self._ring.push(array, dropped=dropped)
+            finally:
+                res.Release()
+        if self.params["beam analysis"].value:
+            self._profiler.measure(frame)
+        # Only signal the GUI once it has handled the previous frame - it always shows the newest one
+        if self._stream_pending:
+            return None
+        self._stream_pending = True
+        return True
+
+    def _on_stream_frame(self, ready):
+        # Signals queued before a restart of the stream can arrive with the new pool still empty
+        if ready is None or not self.params["Stream"].value or self._ring.latest() is None:
+            return
+        self._stream_pending = False
+        # The image getter applies the background correction to the newest frame
+        self.params["image"].get_value()
+        if time.perf_counter() - self._stream_stats_time > 0.5:
+            self._stream_stats_time = time.perf_counter()
+            self["fps"].get_value()
+            self["dropped"].get_value()
+            self["throughput"].get_value()
+
     def setup(self):
         # Setup number of emulation camera to 1
         os.environ["PYLON_CAMEMU"] = "1"
@@ -316,6 +701,9 @@ class Base(pzp.Piece):
     def dispose(self):
         # This function 'disposes' of the camera, effectively disconnecting us
         if hasattr(self, 'camera'):
+            if self._stream_worker is not None:
+                # The setter stops the stream
+                self.params["Stream"].set_value(False)
             self.params['armed'].set_value(0)
             self.imports.FeaturePersistence.Load(self.nodeFile, self.camera.GetNodeMap(), True)
             self.camera.TriggerSelector.Value = "FrameStart"
@@ -415,6 +803,72 @@ class ROI_Popup(pzp.piece.Popup):
 
         return layout
     
+class Beam_Popup(pzp.piece.Popup):
+    FIELDS = ("beam x", "beam y", "D4σ x", "D4σ y", "ellipticity", "peak x", "peak y")
+
+    def define_params(self):
+        self.add_child_params(("beam analysis",) + self.FIELDS)
+        return super().define_params()
+
+    def define_actions(self):
+        @pzp.action.define(self, "Clear")
+        def clear(self):
+            self.parent_piece._profiler.reset()
+            self._display.request()
+
+        @pzp.action.define(self, "Save log")
+        def save_log(self, filename=None):
+            if filename is None:
+                filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+                    self.puzzle, 'Save file as...',
+                    '.', "CSV files (*.csv)")
+            history = self.parent_piece._profiler.history()
+            fields = camera_tools.BeamProfiler.FIELDS
+            np.savetxt(filename, np.column_stack([history[f] for f in fields]),
+                       delimiter=",", header=",".join(fields))
+
+    def custom_layout(self):
+        layout = QtWidgets.QVBoxLayout()
+
+        # Centroid and width against time, for following the beam pointing
+        self.gl = pg.GraphicsLayoutWidget()
+        layout.addWidget(self.gl)
+        plot_position = self.gl.addPlot(0, 0)
+        plot_width = self.gl.addPlot(1, 0)
+        plot_width.setXLink(plot_position)
+        plot_position.setLabel("left", "centroid (px)")
+        plot_width.setLabel("left", "D4σ (px)")
+        plot_width.setLabel("bottom", "time (s)")
+        curves = {}
+        for plot, fields in ((plot_position, ("x", "y")), (plot_width, ("d4s_x", "d4s_y"))):
+            plot.addLegend()
+            plot.setDownsampling(auto=True, mode="peak")
+            plot.setClipToView(True)
+            for field, colour in zip(fields, ("y", "c")):
+                curves[field] = plot.plot([], [], pen=colour, name=field[-1])
+
+        def update_plots():
+            history = self.parent_piece._profiler.history()
+            t = history["time"] - history["time"][0] if len(history) else history["time"]
+            for field, curve in curves.items():
+                curve.setData(t, history[field])
+            for name in self.FIELDS:
+                self.params[name].get_value()
+
+        # A few redraws a second are plenty for a drift log
+        scheduler = display_tools.DisplayScheduler.for_puzzle(self.puzzle)
+        image_changed = self.parent_piece.params["image"].changed
+        self._display = view = scheduler.register(update_plots, 5.)
+        image_changed.connect(view.request)
+
+        # Popups closed with accept() skip handle_close, so clean up once the widget is deleted
+        def remove_view():
+            image_changed.disconnect(view.request)
+            scheduler.unregister(view)
+        self.destroyed.connect(remove_view)
+
+        return layout
+
 class Piece(Base):
     def define_params(self):
         super().define_params()
@@ -427,6 +881,18 @@ class Piece(Base):
             else:
                 self.imgw.setLevels([0, 256])
 
+        # Live view redraws are capped at this rate, frames in between are only counted
+        pzp.param.spinbox(self, "max display fps", 30., v_min=1., visible=False)(None)
+
+        # Rate of frames reaching the image param, and of them being drawn
+        @pzp.param.readout(self, "acquired fps", False, "{:.1f}")
+        def acquired_fps(self):
+            return self._display.acquisition_fps()
+
+        @pzp.param.readout(self, "displayed fps", False, "{:.1f}")
+        def displayed_fps(self):
+            return self._display.display_fps()
+
     # Within this function we can define any other GUI objects we want to display beyond the 
     # params and actions (which are generated by default)
     def custom_layout(self):
@@ -437,6 +903,11 @@ class Piece(Base):
         self.timer = pzp.threads.PuzzleTimer('Live', self.puzzle, self.params['image'].get_value, delay)
         layout.addWidget(self.timer)
 
+        # Live view is fed by the stream worker while streaming
+        def disable_live():
+            self.timer.input.setEnabled(not self["Stream"].value)
+        self.params["Stream"].changed.connect(disable_live)
+
         # Make an ImageView
         self.pw = pg.PlotWidget()
         layout.addWidget(self.pw)
@@ -453,14 +924,23 @@ class Piece(Base):
 
         def update_image():
             self.imgw.setImage(self.params['image'].value, autoLevels=self["autolevel"].value)
-        update_later = pzp.threads.CallLater(update_image)
-        self.params['image'].changed.connect(update_later)
+        self._register_display(update_image)
 
         # histogram = pg.HistogramLUTWidget(orientation='horizontal')
         # layout.addWidget(histogram)
         # histogram.setImageItem(self.imgw)
 
         return layout
+
+    def _register_display(self, update_image):
+        # Redraw at most at "max display fps", with the latest frame
+        self._display = display_tools.DisplayScheduler.for_puzzle(self.puzzle).register(
+            update_image, lambda: self["max display fps"].value, self._display_stats)
+        self.params['image'].changed.connect(self._display.frame)
+
+    def _display_stats(self):
+        self["acquired fps"].get_value()
+        self["displayed fps"].get_value()
     
     def call_stop(self):
         self.timer.stop()
@@ -487,6 +967,11 @@ class LineoutPiece(Piece):
         self.timer = pzp.threads.PuzzleTimer('Live', self.puzzle, self.params['image'].get_value, 0.1)
         layout.addWidget(self.timer)
 
+        # Live view is fed by the stream worker while streaming
+        def disable_live():
+            self.timer.input.setEnabled(not self["Stream"].value)
+        self.params["Stream"].changed.connect(disable_live)
+
         # Make the plots
         self.gl = pg.GraphicsLayoutWidget()
         layout.addWidget(self.gl)
@@ -526,7 +1011,8 @@ class LineoutPiece(Piece):
             image_data = self.params['image'].value
             self.imgw.setImage(image_data, autoLevels=self["autolevel"].value)
             r = self.params['circle_r'].value            
-            roi = self.params["roi"].get_value()
+            with self.trust_cache():
+                roi = self.params["roi"].get_value()
             self._inf_line_x.setBounds([0, roi[3]-roi[1]-1])
             self._inf_line_y.setBounds([0, roi[2]-roi[0]-1])
 
@@ -540,10 +1026,9 @@ class LineoutPiece(Piece):
             except IndexError:
                 raise Exception("Crosshair out-of-range")
             
-        update_later = pzp.threads.CallLater(update_image)
-        self.params['image'].changed.connect(update_later)
-        self._inf_line_x.sigPositionChanged.connect(update_image)
-        self._inf_line_y.sigPositionChanged.connect(update_image)
+        self._register_display(update_image)
+        self._inf_line_x.sigPositionChanged.connect(self._display.request)
+        self._inf_line_y.sigPositionChanged.connect(self._display.request)
 
         return layout
     
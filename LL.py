@@ -1,16 +1,176 @@
 import numpy as np
-from time import sleep
+import os
+import json
+import glob
+from time import sleep, perf_counter
+from collections import deque
 from pyqtgraph.Qt import QtWidgets
 import pyqtgraph as pg
-from pyqtgraph.graphicsItems.NonUniformImage import NonUniformImage
 
 import puzzlepiece as pzp
 import datasets as ds
 import datetime
 
+import display_tools
+
+
+# Spectra of a scan, written to a memory-mapped .npy file as they arrive rather than held in RAM.
+# The number of completed points, their timestamps and `info` go to a .json file next to it
+# every `flush_every` points, so an interrupted scan can be recovered with ScanWriter.load
+# or continued with ScanWriter.reopen.
+class ScanWriter:
+    def __init__(self, path, n_points, frame_shape, dtype=np.int32, info=None, flush_every=10, flush_interval=1.):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.data = np.lib.format.open_memmap(path, "w+", dtype, (n_points, *frame_shape))
+        self.count = 0
+        self.info = {} if info is None else info
+        # Frame times, set by the scan before each spectrum is written
+        self.timestamps = np.zeros(n_points)
+        self.t_start = perf_counter()
+        self._setup(flush_every, flush_interval)
+        self.flush()
+
+    @classmethod
+    def reopen(cls, path, flush_every=10, flush_interval=1.):
+        saved = cls.read_info(path)
+        self = cls.__new__(cls)
+        self.path = path
+        self.data = np.load(path, mmap_mode="r+")
+        self.count = saved["count"]
+        self.info = saved["info"]
+        # Carry on the timestamps from the last completed point
+        elapsed = np.asarray(saved["timestamps"])
+        self.t_start = perf_counter() - (elapsed[-1] if len(elapsed) else 0)
+        self.timestamps = np.zeros(len(self.data))
+        self.timestamps[:self.count] = self.t_start + elapsed
+        self._setup(flush_every, flush_interval)
+        return self
+
+    def _setup(self, flush_every, flush_interval):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._flushed_count = self.count
+        self._last_flush = perf_counter()
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        if isinstance(key, slice):
+            stop = len(self.data) if key.stop is None else key.stop
+        else:
+            stop = key + 1
+        self.count = max(self.count, stop)
+        if self.count - self._flushed_count >= self.flush_every or perf_counter() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def flush(self):
+        self.data.flush()
+        saved = {"count": self.count, "shape": self.data.shape,
+                 "timestamps": (self.timestamps[:self.count] - self.t_start).tolist(), "info": self.info}
+        # Write the new state next to the old one first, so a crash mid-write keeps the last checkpoint
+        info_path = self.info_path(self.path)
+        with open(info_path + ".tmp", "w") as f:
+            json.dump(saved, f, default=_to_json)
+        os.replace(info_path + ".tmp", info_path)
+        self._flushed_count = self.count
+        self._last_flush = perf_counter()
+
+    # Put the first len(order) spectra and timestamps in the given order, so spectrum i becomes
+    # the one that was at order[i]. Done in the file by following each cycle of the permutation,
+    # so only one spectrum is in memory at a time.
+    def reorder(self, order):
+        order = np.asarray(order)
+        self.timestamps[:len(order)] = self.timestamps[order]
+        done = order == np.arange(len(order))
+        for start in range(len(order)):
+            if done[start]:
+                continue
+            first = np.array(self.data[start])
+            i = start
+            while order[i] != start:
+                self.data[i] = self.data[order[i]]
+                done[i] = True
+                i = order[i]
+            self.data[i] = first
+            done[i] = True
+        self.flush()
+
+    # Flush and return the completed spectra, memory-mapped read-only from the file
+    def close(self):
+        self.flush()
+        del self.data
+        return self.load(self.path)
+
+    @staticmethod
+    def info_path(path):
+        return os.path.splitext(path)[0] + ".json"
+
+    @classmethod
+    def read_info(cls, path):
+        with open(cls.info_path(path)) as f:
+            return json.load(f)
+
+    @classmethod
+    def load(cls, path):
+        count = cls.read_info(path)["count"]
+        return np.load(path, mmap_mode="r")[:count]
+
+def _to_json(value):
+    # numpy scalars and arrays from param getters
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+# Andor settings stored with every scan
+ANDOR_SETTINGS = "Andor:exposure, Andor:grating, Andor:centre, Andor:FVB mode, " \
+                 "Andor:amp_mode, Andor:vs_speed, Andor:slit_width, Andor:sum frames"
+
+
+# Midpoints of the `n_new` intervals of (x, y) where the slope changes the most, for adaptive scans.
+# Each inner point scores the change in slope across it times the span of its two intervals,
+# in units normalised to the range of x and y, i.e. how far y strays from a straight line there.
+# An interval takes the larger score of its two ends and is only split if that exceeds `tolerance`.
+def refine_positions(x, y, n_new, tolerance=0.):
+    order = np.argsort(x)
+    x, y = np.asarray(x, float)[order], np.asarray(y, float)[order]
+    if len(x) < 3 or n_new < 1 or x[-1] == x[0]:
+        return np.zeros(0)
+    xs = (x - x[0]) / (x[-1] - x[0])
+    ys = (y - np.amin(y)) / (np.ptp(y) or 1)
+    slopes = np.diff(ys) / np.diff(xs)
+    kink = np.abs(np.diff(slopes)) * (xs[2:] - xs[:-2])
+    loss = np.zeros(len(x) - 1)
+    loss[1:] = kink
+    loss[:-1] = np.maximum(loss[:-1], kink)
+    split = np.argsort(loss)[::-1][:n_new]
+    split = np.sort(split[loss[split] > tolerance])
+    return (x[split] + x[split+1]) / 2
+
+
+# Light-in/light-out curve with a threshold kink, used as the scene in debug mode
+def synthetic_ll(voltage, threshold=2.2, width=0.03, below=0.02):
+    voltage = np.asarray(voltage, float)
+    return below * voltage + width * np.logaddexp(0, (voltage - threshold) / width)
+
 
 class Piece(pzp.Piece):
     def __init__(self, puzzle=None, custom_horizontal=True, *args, **kwargs):
+        # Last scan, and the spectra file it is memory-mapped from, see _drop_result
+        self.result = None
+        self._result_path = None
         super().__init__(puzzle, custom_horizontal, *args, **kwargs)
 
     def define_params(self):
@@ -20,40 +180,230 @@ class Piece(pzp.Piece):
         pzp.param.spinbox(self, "N", 40)(None)
         pzp.param.text(self, "filename", "data/ll.ds")(None)
         pzp.param.progress(self, "progress")(None)
+        # External trigger mode only, 0 for the serial loop. Otherwise the AOM is set for the
+        # next point while a frame is read out, and finished frames are collected once this
+        # many points are queued. The Andor takes one acquisition at a time, so values above 1
+        # only delay collection, see _scan_pipelined
+        pzp.param.spinbox(self, "pipeline depth", 0, v_min=0)(None)
+        pzp.param.readout(self, "points/s", format="{:.2f}")(None)
+        # Rate of the last pipelined or hardware timed scan over the last serial one
+        pzp.param.readout(self, "vs serial", format="{:.2f}x")(None)
+        # Step the AOM from a DAQ buffer clocked by the trigger pulses, see _scan_hardware
+        pzp.param.checkbox(self, "hardware timed", False)(None)
+        pzp.param.spinbox(self, "sweep rate", 5.0, v_min=0.01)(None)
+        # Frames accumulated per point, 0 to use the Andor "accumulate N"
+        pzp.param.spinbox(self, "accumulate N", 0, v_min=0)(None)
+        # Points between checkpoints of the scan file, see "Resume"
+        pzp.param.spinbox(self, "checkpoint every", 10, v_min=1)(None)
+        # Coarse sweep of "coarse N" points, then rounds of "refine batch" points where the
+        # summed output bends the most, until N points or the tolerance is reached
+        pzp.param.checkbox(self, "adaptive", False)(None)
+        pzp.param.spinbox(self, "coarse N", 10, v_min=3)(None)
+        pzp.param.spinbox(self, "refine batch", 4, v_min=1)(None)
+        pzp.param.spinbox(self, "tolerance", 0.005, v_min=0., v_step=0.001)(None)
 
 
-    def _take_ll(self):
-        positions = np.linspace(self["start"].value, self["end"].value, self["N"].value)
-        vary = pzp.parse.parse_params(self["vary"].value, self.puzzle)[0]
+    def _take_ll(self, resume=False):
+        andor = self.puzzle["Andor"]
+        if resume:
+            # Carry on from the last checkpoint of the scan saved under "filename"
+            self._scan_name = self._latest_scan()
+            spectra = ScanWriter.reopen(self._spectra_path(), flush_every=self["checkpoint every"].value)
+            positions = np.asarray(spectra.info["positions"])
+            vary = pzp.parse.parse_params(spectra.info["vary"], self.puzzle)[0]
+            self._restore_andor_settings(spectra.info["Andor"])
+            self._frames_per_point = spectra.info.get("accumulate", 1)
+            start = spectra.count
+        else:
+            # Each scan has its own files, so an earlier one that is still open or not yet saved is kept
+            stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            self._scan_name = self._scan_base() + "_" + stamp
+            N = self["coarse N"].value if self["adaptive"].value else self["N"].value
+            positions = np.linspace(self["start"].value, self["end"].value, N)
+            vary = pzp.parse.parse_params(self["vary"].value, self.puzzle)[0]
+            self._frames_per_point = self["accumulate N"].value or andor["accumulate N"].value
+            start = 0
         
         # Make sure the laser is not free-running
         if self.puzzle["Spot trigger"]["FIRE LASER"].value:
             self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
-        vary.set_value(positions[0])
+        vary.set_value(positions[min(start, len(positions)-1)])
 
-        # Get background
-        self.puzzle["Andor"].actions["Take background"]()
-        background = self.puzzle["Andor"]["background"].value
-        self.puzzle.process_events()
+        if self.puzzle.debug:
+            self._use_synthetic_scene()
+        if resume:
+            background = np.load(self._scan_path("_background.npy"))
+            andor["background"].set_value(background)
+        else:
+            # Get background, accumulated like the spectra
+            background = andor.acquire_background(self._frames_per_point)
+            self.puzzle.process_events()
         
-        self.puzzle["Andor"]["sub_background"].set_value(False)
-        # Make empty arrays for the values
-        spectra = np.zeros((len(positions), *background.shape), np.int32)
-        powers = np.zeros(len(positions))
+        andor["sub_background"].set_value(False)
+        if not resume:
+            # Spectra go straight to disk, next to the final dataset, together with what is needed to resume
+            info = {"vary": self["vary"].value, "positions": positions, "Andor": self._andor_settings(),
+                    "accumulate": self._frames_per_point}
+            size = len(positions)
+            if self["adaptive"].value:
+                info["adaptive"] = {"batch": self["refine batch"].value, "tolerance": self["tolerance"].value}
+                size = max(size, self["N"].value)
+            # Averaged accumulations are not whole counts
+            averaged = self._frames_per_point > 1 and not andor["sum frames"].value
+            dtype = np.float32 if averaged else np.int32
+            spectra = ScanWriter(self._spectra_path(), size, background.shape, dtype, info=info,
+                                 flush_every=self["checkpoint every"].value)
+            np.save(self._scan_path("_background.npy"), background)
+        powers = np.zeros(len(spectra))
         
-        if not self.puzzle["Andor"]["External trigger"].value:
+        if not andor["External trigger"].value:
             # Free-running laser for internal trigger
             self.puzzle["Spot trigger"]["FIRE LASER"].set_value(1)
 
         # Scan position and save the spectra
         self.stop = False
-        for i, pos in enumerate(self["progress"].iter(positions)):
+        timestamps = spectra.timestamps
+        depth = self["pipeline depth"].value
+        pipelined = depth > 0 and andor["External trigger"].value
+        hardware = self["hardware timed"].value
+        mode = "hardware timed" if hardware else "pipelined" if pipelined else "serial"
+        adaptive = spectra.info.get("adaptive")
+        t_scan = perf_counter()
+        try:
+            n = self._scan(positions, vary, spectra, timestamps, start, mode, depth)
+            # Add points where the summed output bends the most, until the budget or tolerance is reached
+            while adaptive and n < len(spectra):
+                totals = np.asarray(spectra[:n]).reshape(n, -1).sum(axis=1)
+                new = refine_positions(positions[:n], totals, min(adaptive["batch"], len(spectra) - n), adaptive["tolerance"])
+                if not len(new):
+                    break
+                positions = np.append(positions[:n], new)
+                spectra.info["positions"] = positions
+                n = self._scan(positions, vary, spectra, timestamps, n, mode, depth)
+        finally:
+            spectra.flush()
+        rate = (n - start) / (perf_counter() - t_scan)
+
+        # Stop triggering laser
+        self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+
+        t_start = spectra.t_start
+        positions = positions[:n]
+        if adaptive:
+            # Points were taken in rounds, put them in order of position in the scan file
+            order = np.argsort(positions, kind="stable")
+            positions = positions[order]
+            spectra.info["positions"] = positions
+            spectra.reorder(order)
+        spectra = spectra.close()[:n]
+        timestamps = timestamps[:n]
+        powers = powers[:n]
+        self._report_rate(rate, mode)
+        
+        # Make a dataset for the data
+        ll = ds.dataset(spectra, aom_voltage=np.asarray(positions), pixel=np.arange(spectra.shape[1]), wl=andor["wls"].value)
+        ll.metadata['background'] = background
+        if andor["background frames"].value > 1:
+            ll.metadata['background noise'] = andor["background noise"].value
+        # Frame arrival times in seconds from the start of the scan, not counting any time before a resume
+        ll.metadata['timestamps'] = timestamps - t_start
+        ll.metadata['pipeline depth'] = depth if pipelined and not hardware else 0
+        ll.metadata['sweep rate'] = self["sweep rate"].value if hardware else 0
+        ll.metadata['adaptive'] = bool(adaptive)
+        ll.metadata['accumulate N'] = self._frames_per_point
+        if resume:
+            ll.metadata['resumed at'] = start
+        self._drop_result()
+        self.result = ll
+        
+        self.update_plot(ll)
+        self.elevate()
+        
+        andor["sub_background"].set_value(True)
+
+        return ll
+
+    def _scan(self, positions, vary, spectra, timestamps, start, mode, depth):
+        if start == len(positions):
+            return start
+        if mode == "hardware timed":
+            return self._scan_hardware(positions, vary, spectra, timestamps, start)
+        if mode == "pipelined":
+            return self._scan_pipelined(positions, vary, spectra, timestamps, depth, start)
+        return self._scan_serial(positions, vary, spectra, timestamps, start)
+
+    # Debug mode: the simulated Andor sees a lasing line whose brightness follows
+    # synthetic_ll at the AOM voltage of each exposure
+    def _use_synthetic_scene(self):
+        cam = self.puzzle["Andor"]._camera()
+        if cam.scene is None:
+            cam.scene = self._synthetic_scene
+
+    def _synthetic_scene(self, shape, t):
+        if getattr(self, "_scene_profile", None) is None or self._scene_profile.shape != shape:
+            rows, cols = np.ogrid[:shape[0], :shape[1]]
+            self._scene_profile = 2000 * np.exp(-((cols - shape[1]/2) / 4)**2 - ((rows - shape[0]/2) / (shape[0]/4 + 1))**2)
+        if "NIDAQ" in self.puzzle.pieces and hasattr(self.puzzle["NIDAQ"], "daq"):
+            voltage = self.puzzle["NIDAQ"].daq.voltage_at("AOM_mod_in", t)
+        else:
+            voltage = self.puzzle["AOM"]["mod_in"].value or 0
+        return self._scene_profile * synthetic_ll(voltage)
+
+    # Andor settings for the scan metadata, read in internal trigger mode
+    def _andor_settings(self):
+        andor = self.puzzle["Andor"]
+        trigger_mode = andor['External trigger'].value
+        with andor.trust_cache():
+            # Settings read or set since connecting need no SDK calls, so no switch to internal trigger either
+            if andor.cache_covers([name.split(":")[1] for name in ANDOR_SETTINGS.split(", ")]):
+                settings = self.puzzle.record_values(ANDOR_SETTINGS)
+            else:
+                andor['External trigger'].set_value(False)
+                settings = self.puzzle.record_values(ANDOR_SETTINGS)
+                andor['External trigger'].set_value(trigger_mode)
+        settings["Andor:External trigger"] = trigger_mode
+        return settings
+
+    # Put the Andor back the way it was when a resumed scan started
+    def _restore_andor_settings(self, settings):
+        with self.puzzle["Andor"].configure() as config:
+            for name, value in settings.items():
+                if value is not None:
+                    config[name.split(":", 1)[1]] = value
+
+    def _scan_base(self):
+        return os.path.splitext(pzp.parse.format(self["filename"].value, self.puzzle))[0]
+
+    # Files of the current scan are named "<filename>_<start time><suffix>"
+    def _scan_path(self, suffix):
+        return self._scan_name + suffix
+
+    # Name of the most recently checkpointed scan saved under "filename", for "Resume"
+    def _latest_scan(self):
+        infos = glob.glob(glob.escape(self._scan_base()) + "_*_spectra.json")
+        if not infos:
+            raise Exception(f"No scan to resume at {self._scan_base()}")
+        return max(infos, key=os.path.getmtime).removesuffix("_spectra.json")
+
+    def _spectra_path(self):
+        return self._scan_path("_spectra.npy")
+
+    # One point at a time: set the AOM, take a frame while refreshing the GUI
+    def _scan_serial(self, positions, vary, spectra, timestamps, start=0):
+        for i in self["progress"].iter(range(start, len(positions))):
+            pos = positions[i]
             if pos < vary.input.minimum() or pos > vary.input.maximum():
                 self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
                 raise Exception("Scan range over the limits")
             vary.set_value(pos)
 
-            spectra[i] = self.puzzle["Andor"].get_image()
+            # Keep the GUI responsive during the exposure
+            future = self.puzzle["Andor"].acquire_async(self._frames_per_point, accumulate=self._frames_per_point > 1)
+            while not future.done():
+                self.puzzle.process_events()
+                sleep(1e-3)
+            spectra[i] = future.result()[0]
+            timestamps[i] = future.timestamps[-1]
 
             # powers[i] = self.puzzle['powermeter']['power'].get_value()
             if self.stop:
@@ -61,43 +411,171 @@ class Piece(pzp.Piece):
                 raise Exception("User interruption")
             
             self.puzzle.process_events()
+        return i+1
 
-        # Stop triggering laser
-        self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+    # External trigger only: once the pulse train for point i has gone out, the AOM is set
+    # for point i+1 while frame i is still being read out. The Andor runs one acquisition at
+    # a time, so this overlap is all the pipelining there is: `depth` is a collection lag,
+    # the number of points queued before finished frames are copied into the scan file.
+    def _scan_pipelined(self, positions, vary, spectra, timestamps, depth, start=0):
+        andor = self.puzzle["Andor"]
+        if np.amin(positions) < vary.input.minimum() or np.amax(positions) > vary.input.maximum():
+            self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+            raise Exception("Scan range over the limits")
+        # acquire_async allows 5 s per frame
+        timeout = 5 * self._frames_per_point
 
-        spectra = spectra[:i+1]
-        powers = powers[:i+1]
-        
-        # Make a dataset for the data
-        ll = ds.dataset(spectra, aom_voltage=np.asarray(positions), pixel=np.arange(spectra.shape[1]), wl=self.puzzle["Andor"]["wls"].value)
-        ll.metadata['background'] = background
-        self.result = ll
-        
-        self.update_plot(ll)
-        self.elevate()
-        
-        self.puzzle["Andor"]["sub_background"].set_value(True)
+        pending = deque()
+        n = start
+        vary.set_value(positions[start])
+        for i in self["progress"].iter(range(start, len(positions))):
+            future = andor.acquire_async(self._frames_per_point, accumulate=self._frames_per_point > 1)
+            pending.append((i, future))
+            # Queued acquisitions run first, so allow for each of them
+            self._wait_for(future.triggered.is_set, timeout * len(pending), "trigger sent", interruptible=True)
+            if i+1 < len(positions) and not self.stop:
+                vary.set_value(positions[i+1])
 
-        return ll
+            last = i == len(positions) - 1
+            collected = False
+            while pending and (len(pending) >= depth or last or self.stop):
+                j, future = pending.popleft()
+                self._wait_for(future.done, timeout * (len(pending) + 1), "frame received")
+                timestamps[j] = future.timestamps[-1]
+                spectra[j] = future.result()[0]
+                n = j+1
+                collected = True
+
+            if self.stop:
+                self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+                raise Exception("User interruption")
+            # The waits only refresh the GUI while something is outstanding, so refresh here too
+            if collected:
+                self.puzzle.process_events()
+        return n
+
+    # Refresh the GUI until `done()` is true, or until Stop is pressed if `interruptible`
+    def _wait_for(self, done, timeout, what, interruptible=False):
+        t_end = perf_counter() + timeout
+        while not done():
+            if interruptible and self.stop:
+                return
+            if perf_counter() > t_end:
+                self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+                raise Exception(f"No {what} within {timeout} s")
+            self.puzzle.process_events()
+            sleep(1e-3)
+
+    # The Spot trigger counter sends a finite train of N pulses at "sweep rate", the Andor takes
+    # a kinetic series with one frame per pulse, and the DAQ steps the AOM to the next point on
+    # the falling edge of each pulse. No software timing is involved between points.
+    def _scan_hardware(self, positions, vary, spectra, timestamps, start=0):
+        andor = self.puzzle["Andor"]
+        nidaq = self.puzzle["NIDAQ"]
+        spot = self.puzzle["Spot trigger"]
+        if self["vary"].value.strip() != "AOM:mod_in":
+            raise Exception("Hardware timed scans can only vary AOM:mod_in")
+        if not andor["External trigger"].value:
+            raise Exception("Hardware timed scans need the Andor in external trigger mode")
+        if not hasattr(nidaq, "daq"):
+            raise Exception("NI DAQ not connected")
+        if np.amin(positions) < vary.input.minimum() or np.amax(positions) > vary.input.maximum():
+            raise Exception("Scan range over the limits")
+        # One pulse and frame per accumulated frame, "sweep rate" points per second
+        k = self._frames_per_point
+        period = 1 / (self["sweep rate"].value * k)
+        exposure = andor["exposure"].value * 1e-3
+        if period <= exposure:
+            raise Exception(f"Sweep rate too high for the {exposure*1e3:.1f} ms exposure")
+
+        positions = positions[start:]
+        N = len(positions)
+        vary.set_value(positions[0])
+        future = andor.acquire_kinetic(N * k, timeout=period + 5)
+        # One sample per pulse, the last one holds the final point
+        waveform = np.repeat(positions, k)
+        nidaq.start_clocked_voltage_output("AOM_mod_in", np.append(waveform[1:], waveform[-1]),
+                                           spot["counter"].value, max_rate=2 / period)
+        if self.puzzle.debug:
+            nidaq.daq.connect_pulse_output("laser_trigger", andor.sim_trigger)
+        try:
+            spot.send_pulses(N * k, period)
+            while not future.done():
+                self["progress"].set_value(len(future.timestamps) / (N * k))
+                if self.stop:
+                    future.abort.set()
+                    raise Exception("User interruption")
+                self.puzzle.process_events()
+                sleep(0.01)
+            frames = future.result()
+        finally:
+            spot.reset_pulse_output()
+            if self.puzzle.debug:
+                nidaq.daq.disconnect_pulse_output("laser_trigger", andor.sim_trigger)
+            # Hold the AOM where the sweep stopped
+            last = waveform[min(len(future.timestamps), N*k - 1)]
+            nidaq.stop_clocked_voltage_output("AOM_mod_in", last)
+            vary.set_value(last)
+
+        n = len(frames) // k
+        self["progress"].set_value(n / N)
+        timestamps[start:start+n] = future.timestamps[k-1:n*k:k]
+        if k > 1:
+            frames = [andor.combine_frames(frames[i*k:(i+1)*k]) for i in range(n)]
+        spectra[start:start+n] = frames[:n]
+        return start + n
+
+    def _report_rate(self, rate, mode):
+        # Compare against the last serial scan, if there was one
+        if mode == "serial":
+            self._serial_rate = rate
+        elif getattr(self, "_serial_rate", None):
+            self["vs serial"].set_value(rate / self._serial_rate)
+        self["points/s"].set_value(rate)
 
     def define_actions(self):
         @pzp.action.define(self, "Scan")
         def scan(self):
+            self._run_scan()
+
+        # Continue the interrupted scan saved under "filename" from its last checkpoint
+        @pzp.action.define(self, "Resume")
+        def resume(self):
+            self._run_scan(resume=True)
+
+    def _run_scan(self, resume=False):
+        try:
+            ll = self._take_ll(resume)
+        finally:
+            self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+
+        # Record Andor parameters in internal trigger mode
+        ll.metadata.update(self._andor_settings())
+        ll.metadata["timestamp"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        filename = pzp.parse.format(self["filename"].value, self.puzzle)
+        ll.save(filename, 2)
+
+        # The saved dataset replaces the scan files. The result stays mapped from the spectra
+        # file instead of being loaded into memory, so that one is kept until the next scan
+        for suffix in ("_spectra.json", "_background.npy"):
+            if os.path.exists(self._scan_path(suffix)):
+                os.remove(self._scan_path(suffix))
+        self._result_path = self._spectra_path()
+
+    # Forget the last result and delete the spectra file backing it, which only works on
+    # Windows once nothing else holds a reference to the spectra
+    def _drop_result(self):
+        path, self._result_path = self._result_path, None
+        self.result = None
+        if path is not None and os.path.exists(path):
             try:
-                ll = self._take_ll()
-            finally:
-                self.puzzle["Spot trigger"]["FIRE LASER"].set_value(0)
+                os.remove(path)
+            except PermissionError:
+                print(f"Could not delete {path}, it is still in use")
 
-            # Record Andor parameters in internal trigger mode
-            trigger_mode = self.puzzle["Andor"]['External trigger'].value
-            self.puzzle["Andor"]['External trigger'].set_value(False)
-            self.puzzle.record_values(  "Andor:exposure, Andor:grating, Andor:centre, Andor:FVB mode, " \
-                                        "Andor:amp_mode, Andor:vs_speed, Andor:slit_width", 
-                                        ll.metadata)
-            ll.metadata["Andor:External trigger"] = trigger_mode
-            ll.metadata["timestamp"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-            self.puzzle["Andor"]['External trigger'].set_value(trigger_mode)
-            ll.save(pzp.parse.format(self["filename"].value, self.puzzle), 2)
+    # The last scan is saved in the dataset, its spectra file is not needed after closing
+    def handle_close(self, event):
+        self._drop_result()
         
     def custom_layout(self):
         layout = QtWidgets.QVBoxLayout()
@@ -106,6 +584,7 @@ class Piece(pzp.Piece):
         layout.addWidget(self.gl)
 
         self.plot1 = self.gl.addPlot(0, 0)
+        self._grid = display_tools.UniformGrid()
         self.plot2 = self.gl.addPlot(0, 1)
         self.plot_line1 = self.plot2.plot()
         self.plot3 = self.gl.addPlot(0, 2)
@@ -118,11 +597,10 @@ class Piece(pzp.Piece):
         values = ll.take_sum('pixel').raw.astype(float) - np.sum(ll.metadata['background'].astype(float), axis=0)
         values /= np.amax(values, axis=1).reshape((-1, 1))
         self.plot1.clear()
-        # try:
-        #     nui = NonUniformImage(ll.wl, ll.power, values.T)
-        #     self.plot1.addItem(nui)
-        # except:
-        ui = pg.ImageItem(values.T)
+        # Map over wavelength and AOM voltage, resampled onto a uniform grid for a single ImageItem
+        image, rect = self._grid.resample(values, ll.wl, ll.aom_voltage)
+        ui = pg.ImageItem(image, axisOrder='row-major')
+        ui.setRect(rect)
         self.plot1.addItem(ui)
         self.plot_line1.setData(ll.aom_voltage, ll.take_sum('pixel').take_sum('wl').raw - np.sum(ll.metadata['background']))
         self.plot_line2.setData(ll.aom_voltage, ll.take_sum('pixel').take_sum('wl').raw - np.sum(ll.metadata['background']))
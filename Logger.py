@@ -0,0 +1,156 @@
+import puzzlepiece as pzp
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtWidgets
+import numpy as np
+import time
+
+import display_tools
+import log_tools
+
+# Plot spans offered by the "window" dropdown, in seconds
+WINDOWS = {"1 min": 60, "10 min": 600, "1 hour": 3600, "1 day": 86400, "1 week": 7*86400}
+
+class Settings(pzp.piece.Popup):
+    def define_params(self):
+        self.add_child_params(("query", "folder", "flush every", "samples"))
+        return super().define_params()
+
+    def define_actions(self):
+        self.add_child_actions(("Flush", "Clear"))
+        return super().define_actions()
+
+class Piece(pzp.Piece):
+    """
+    Logs readouts of other pieces (power, temperature, counts, ...) at a set rate. Each one is
+    kept in a fixed-size :class:`log_tools.DecimatedSeries`, so memory stays flat over long runs
+    and any window from a minute to a week plots straight away, and new samples are saved to
+    compressed chunks in "folder" every "flush every" minutes.
+    """
+    def __init__(self, puzzle):
+        self._series = {}
+        self._sources = {}
+        super().__init__(puzzle, custom_horizontal=True)
+        self._last_flush = time.perf_counter()
+
+    def define_params(self):
+        # Readouts to log, as "piece:param, piece:param", applied when logging starts
+        pzp.param.text(self, "readouts", "powermeter:power")(None)
+        # Samples per second
+        pzp.param.spinbox(self, "rate", 1., v_min=0.001)(None)
+
+        pzp.param.dropdown(self, "window", "10 min")(None)
+        self.params["window"].input.addItems(list(WINDOWS))
+
+        # Call each readout's getter, otherwise log the value it last showed. Turn off for
+        # readouts that acquire, like Andor "counts", to log what the live view reads
+        pzp.param.checkbox(self, "query", 1, visible=False)(None)
+        pzp.param.text(self, "folder", "logs", visible=False)(None)
+        # Minutes between saving new samples to disk, 0 to only save with "Flush"
+        pzp.param.spinbox(self, "flush every", 10., v_min=0., visible=False)(None)
+
+        @pzp.param.readout(self, "samples", False)
+        def samples(self):
+            return sum(len(series) for series in self._series.values())
+
+    def define_actions(self):
+        @pzp.action.define(self, "Flush")
+        def flush(self):
+            self._last_flush = time.perf_counter()
+            for name, series in list(self._series.items()):
+                log_tools.write_chunk(self["folder"].value, name, *series.flush())
+
+        @pzp.action.define(self, "Clear")
+        def clear(self):
+            self._series = {name: log_tools.DecimatedSeries() for name in self._sources}
+            self._display.request()
+
+        @pzp.action.define(self, "Settings")
+        def settings(self):
+            self.open_popup(Settings, "Logger settings")
+
+    def custom_layout(self):
+        layout = QtWidgets.QVBoxLayout()
+
+        self.timer = pzp.threads.PuzzleTimer('Log', self.puzzle, self._sample, 1 / self["rate"].value)
+        layout.addWidget(self.timer)
+
+        def set_rate():
+            self.timer.sleep = 1 / self["rate"].value
+        self.params["rate"].changed.connect(set_rate)
+
+        def set_sources(state):
+            if self.timer.input.isChecked():
+                self._set_sources()
+        self.timer.input.checkStateChanged.connect(set_sources)
+
+        self.gl = pg.GraphicsLayoutWidget()
+        layout.addWidget(self.gl)
+        self._make_plots()
+
+        self._display = display_tools.DisplayScheduler.for_puzzle(self.puzzle).register(self._update_plots, 5.)
+        self.timer.returned.connect(self._display.frame)
+        self.params["window"].changed.connect(self._display.request)
+
+        return layout
+
+    def _set_sources(self):
+        # Comma separated, with or without spaces. parse_params wants ", " between names
+        names = [name.strip() for name in self["readouts"].value.split(",") if name.strip()]
+        sources = dict(zip(names, pzp.parse.parse_params(", ".join(names), self.puzzle)))
+        # Keep the history of readouts that are still logged
+        self._series = {name: self._series.get(name) or log_tools.DecimatedSeries() for name in names}
+        self._sources = sources
+        self._make_plots()
+
+    def _make_plots(self):
+        # One plot per readout: the mean, with the min-max range of each block shaded
+        self.gl.clear()
+        self._curves = {}
+        for i, name in enumerate(self._series):
+            plot = self.gl.addPlot(i, 0, axisItems={"bottom": pg.DateAxisItem()})
+            plot.setLabel("left", name)
+            low, high = plot.plot([], []), plot.plot([], [])
+            plot.addItem(pg.FillBetweenItem(low, high, brush=(100, 100, 255, 80)))
+            self._curves[name] = (low, high, plot.plot([], [], pen="y"))
+
+    def _update_plots(self):
+        span = WINDOWS[self["window"].value]
+        for name, (low, high, mean) in self._curves.items():
+            rows = self._series[name].window(span, now=time.time())
+            low.setData(rows[:, 0], rows[:, 1])
+            high.setData(rows[:, 0], rows[:, 2])
+            mean.setData(rows[:, 0], rows[:, 3])
+        self["samples"].get_value()
+
+    # Timer function: read every readout once, then save to disk if it's time
+    def _sample(self):
+        t = time.time()
+        for name, param in list(self._sources.items()):
+            try:
+                value = float(param.get_value() if self["query"].value else param.value)
+            except Exception:
+                # Disconnected device or a non-numeric readout, skip this sample
+                continue
+            self._series[name].append(t, value)
+        flush_every = self["flush every"].value
+        if flush_every and time.perf_counter() - self._last_flush > flush_every * 60:
+            self.actions["Flush"]()
+        else:
+            # At high rates the raw ring fills before "flush every" is up, save it before samples are lost
+            for name, series in list(self._series.items()):
+                if series.unflushed() >= series.capacity // 2:
+                    log_tools.write_chunk(self["folder"].value, name, *series.flush())
+        return t
+
+    def handle_close(self, event):
+        self.actions["Flush"]()
+
+
+if __name__ == "__main__":
+    import ThorlabsPM
+    app = QtWidgets.QApplication([])
+    puzzle = pzp.Puzzle(app, "Lab", debug=False)
+    puzzle.add_piece("powermeter", ThorlabsPM.Piece(puzzle), 0, 0)
+    puzzle.add_piece("Logger", Piece(puzzle), 0, 1)
+    puzzle.show()
+    app.exec()
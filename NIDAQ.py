@@ -1,6 +1,8 @@
 import puzzlepiece as pzp
+import numpy as np
 from pyqtgraph.Qt import QtWidgets
 from pylablib.devices import NI
+from hardware import daq_sim
 
 class Piece(pzp.Piece):  
     def define_params(self):
@@ -9,7 +11,11 @@ class Piece(pzp.Piece):
         @pzp.param.checkbox(self, "connected", 0)
         def connect(self, value):
             if self.puzzle.debug:
-                self.daq = NI.NIDAQ("Dev1")
+                # Simulated card, so that scans using the DAQ can run without hardware
+                if value and not hasattr(self, 'daq'):
+                    self.daq = daq_sim.SimNIDAQ("Dev1")
+                elif not value:
+                    self.dispose()
                 return value
             
             # Check if we're currently connected by checking what the state of the checkbox was
@@ -35,6 +41,37 @@ class Piece(pzp.Piece):
         if not self.puzzle.debug and not hasattr(self, 'daq'):
             raise Exception("NI DAQ not connected")
 
+    # Play `waveform` on the analog output `name`, one sample per falling edge of the pulse
+    # output running on `counter` (e.g. "CTR0"). The samples are written once the pulse train
+    # is started, so the output steps right after each pulse without any software timing.
+    def start_clocked_voltage_output(self, name, waveform, counter, max_rate=1e3):
+        self._ensure_connected()
+        waveform = np.asarray(waveform, float)
+        if self.puzzle.debug:
+            self.daq.setup_clocked_voltage_output(name, waveform, counter)
+            return
+        # pylablib only clocks the analog outputs internally or from the AI clock,
+        # so the nidaqmx task is configured directly
+        from nidaqmx.constants import AcquisitionType, Edge
+        if self.daq.get_voltage_output_channels() != [name]:
+            raise Exception(f"Clocked output needs {name} to be the only analog output")
+        task = self.daq.ao_task
+        task.stop()
+        task.timing.cfg_samp_clk_timing(max_rate, source=f"/{self.daq.dev_name}/{counter.capitalize()}InternalOutput",
+                                        active_edge=Edge.FALLING, sample_mode=AcquisitionType.FINITE,
+                                        samps_per_chan=len(waveform))
+        task.write(waveform, auto_start=True)
+
+    # Return the analog output to on-demand updates, holding `value`
+    def stop_clocked_voltage_output(self, name, value):
+        if self.puzzle.debug:
+            self.daq.stop_clocked_voltage_output(name)
+            self.daq.set_voltage_outputs(name, value)
+            return
+        self.daq.ao_task.stop()
+        self.daq.setup_voltage_output_clock(rate=0)
+        self.daq.set_voltage_outputs(name, value)
+
     def dispose(self):
         if hasattr(self, 'daq'):
             self.daq.close()
@@ -42,13 +42,13 @@ class Piece(pzp.Piece):
         def armed(self, value):
             if self.puzzle.debug:
                 self.params["Unlock"].set_value(False)
+                # Register the output with the simulated DAQ if there is one
+                if value and "NIDAQ" in self.puzzle.pieces and hasattr(self.puzzle["NIDAQ"], "daq"):
+                    self._add_trigger_output()
                 return value
             current_value = self.params['armed'].value
             if value and not current_value:
-                max_freq = self.params["Rep rate"].get_value() * 1e3
-                period = 1/max_freq
-                self.puzzle["NIDAQ"].daq.add_pulse_output("laser_trigger", self.params["counter"].value, self.params["PFI port"].value, 
-                                                          kind='time', on=period/2, off=period/2, clk_src=None, continuous=True, samps=1)
+                self._add_trigger_output()
                 return True
             self.params["Unlock"].set_value(False)
             return False
@@ -114,6 +114,26 @@ class Piece(pzp.Piece):
                 self.puzzle["NIDAQ"].daq.start_pulse_output(names="laser_trigger", autostop=True)
             print("Pulse(s) sent")
 
+    def _add_trigger_output(self):
+        period = 1/(self.params["Rep rate"].get_value() * 1e3)
+        self.puzzle["NIDAQ"].daq.add_pulse_output("laser_trigger", self.params["counter"].value, self.params["PFI port"].value, 
+                                                  kind='time', on=period/2, off=period/2, clk_src=None, continuous=True, samps=1)
+
+    # Finite train of n pulses spaced by `period` seconds, e.g. as the sample clock of a
+    # hardware-timed scan. Call reset_pulse_output() afterwards to go back to "Rep rate".
+    def send_pulses(self, n, period):
+        self._ensure_daq()
+        self._ensure_unlocked()
+        daq = self.puzzle["NIDAQ"].daq
+        daq.set_pulse_output("laser_trigger", on=period/2, off=period/2, continuous=False, samps=int(n))
+        daq.start_pulse_output(names="laser_trigger", autostop=True)
+
+    def reset_pulse_output(self):
+        period = 1/(self.params["Rep rate"].get_value() * 1e3)
+        daq = self.puzzle["NIDAQ"].daq
+        daq.stop_pulse_output(names="laser_trigger")
+        daq.set_pulse_output("laser_trigger", on=period/2, off=period/2, continuous=True)
+
     # Ensure devices are connected
     @pzp.piece.ensurer        
     def _ensure_daq(self):
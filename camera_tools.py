@@ -0,0 +1,572 @@
+import numpy as np
+import threading
+import time
+import os
+import io
+import contextlib
+import functools
+import warnings
+from collections import OrderedDict
+
+# Frame-handling helpers shared by the camera pieces (Andor, Basler).
+# Only numpy is needed here, so these can be used and benchmarked without the GUI.
+
+
+class FrameRing:
+    """
+    Preallocated ring of camera frames, filled by an acquisition thread with
+    :func:`push` and read by the GUI with :func:`latest`.
+
+    :func:`latest` returns a view of the newest slot, not a copy. A slot is only
+    written over after `depth` - 1 further frames, so `depth` should cover the
+    number of frames that can arrive while a consumer holds on to a view.
+    Consumers that need every frame read them in order with :func:`get`.
+    The buffer is allocated on the first frame and again whenever the frame shape
+    or dtype changes (ROI, binning or read mode changes).
+    """
+
+    def __init__(self, depth=8):
+        self.depth = int(depth)
+        self._buffer = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._newest = -1
+            # Number of the frame in slot 0
+            self._base = 0
+            self._times = np.zeros(self.depth)
+            #: Number of frames pushed since the last reset
+            self.frames = 0
+            #: Number of frames the source reported as lost since the last reset
+            self.dropped = 0
+
+    def _allocate(self, frame):
+        if self._buffer is None or self._buffer.shape[1:] != frame.shape or self._buffer.dtype != frame.dtype:
+            self._buffer = np.empty((self.depth, *frame.shape), frame.dtype)
+            self._newest = -1
+            self._base = self.frames
+
+    def push(self, frame, dropped=0):
+        frame = np.asarray(frame)
+        self._allocate(frame)
+        slot = (self._newest + 1) % self.depth
+        np.copyto(self._buffer[slot], frame)
+        with self._lock:
+            self._newest = slot
+            self._times[slot] = time.perf_counter()
+            self.frames += 1
+            self.dropped += dropped
+        return self._buffer[slot]
+
+    def latest(self):
+        with self._lock:
+            if self._newest < 0:
+                return None
+            return self._buffer[self._newest]
+
+    def get(self, index):
+        """
+        (view, arrival time) of frame number `index` since the last reset, or None if it
+        hasn't arrived yet. Raises IndexError if it has already been written over.
+        After using the view, check with :func:`holds` that it wasn't written over meanwhile.
+        """
+        with self._lock:
+            if index >= self.frames:
+                return None
+            if not self.holds(index):
+                raise IndexError(f"Frame {index} has been written over")
+            slot = (index - self._base) % self.depth
+            return self._buffer[slot], self._times[slot]
+
+    def holds(self, index):
+        # The frame being pushed next writes over frame number `frames` - `depth`
+        return index >= max(self.frames - self.depth + 1, self._base)
+
+    def fps(self):
+        # Frame rate over the frames currently held in the ring
+        with self._lock:
+            n = min(self.frames, self.depth)
+            if n < 2:
+                return 0.
+            t_newest = self._times[self._newest]
+            t_oldest = self._times[(self._newest - n + 1) % self.depth]
+        if t_newest <= t_oldest:
+            return 0.
+        return (n - 1) / (t_newest - t_oldest)
+
+
+class FrameAccumulator:
+    """
+    Sums frames in place into a single preallocated buffer: int64 for integer frames,
+    float64 otherwise. With `variance=True` it keeps a running mean and sum of squared
+    deviations instead (Welford's algorithm), for per-pixel noise maps.
+
+    The buffers are allocated on the first frame after a :func:`reset`, or when the frame
+    shape changes, so adding frames does not allocate.
+    """
+
+    def __init__(self, variance=False):
+        self.variance = variance
+        self._shape = None
+        self.reset()
+
+    def reset(self):
+        #: Number of frames added since the last reset
+        self.n = 0
+
+    def _allocate(self, frame):
+        if self._shape == frame.shape:
+            return
+        self._shape = frame.shape
+        if self.variance:
+            self._mean = np.empty(frame.shape)
+            self._m2 = np.empty(frame.shape)
+            self._delta = np.empty(frame.shape)
+            self._tmp = np.empty(frame.shape)
+        else:
+            self._sum = np.empty(frame.shape, np.int64 if frame.dtype.kind in "iub" else np.float64)
+
+    def add(self, frame):
+        frame = np.asarray(frame)
+        self._allocate(frame)
+        self.n += 1
+        if not self.variance:
+            if self.n == 1:
+                np.copyto(self._sum, frame)
+            else:
+                np.add(self._sum, frame, out=self._sum, casting="unsafe")
+            return
+        if self.n == 1:
+            np.copyto(self._mean, frame)
+            self._m2.fill(0)
+            return
+        # mean += (x - mean) / n, m2 += (x - mean_old) * (x - mean_new)
+        np.subtract(frame, self._mean, out=self._delta)
+        np.multiply(self._delta, 1 / self.n, out=self._tmp)
+        self._mean += self._tmp
+        np.subtract(frame, self._mean, out=self._tmp)
+        self._tmp *= self._delta
+        self._m2 += self._tmp
+
+    def sum(self):
+        if self.variance:
+            return self._mean * self.n
+        return self._sum
+
+    def mean(self):
+        if self.variance:
+            return self._mean
+        return self._sum / self.n
+
+    def var(self):
+        # Unbiased per-pixel variance, needs variance=True
+        if self.n < 2:
+            return np.zeros(self._shape)
+        return self._m2 / (self.n - 1)
+
+
+class BackgroundCorrector:
+    """
+    Dark and flat-field correction, ``(frame - dark) * gain`` with
+    ``gain = mean(flat - dark) / (flat - dark)``.
+
+    The dark frame is cast to the working dtype and the flat-field gain is worked out once,
+    the first time they are used, and again only when a different array is passed in, rather
+    than on every frame. The output is int32 for integer frames without a flat field and
+    float32 otherwise, and is a new array on every call, so callers can keep it.
+    """
+
+    def __init__(self):
+        self._dark_source = None
+        self._flat_source = None
+        self._gain = None
+
+    def _prepare(self, frame, dark, flat):
+        if dark.shape != frame.shape:
+            raise Exception(f"Background shape {dark.shape} does not match the frame {frame.shape}, take a new one")
+        if dark is not self._dark_source:
+            self._dark_source = dark
+            self._dark = dark.astype(np.int32 if dark.dtype.kind in "iub" else np.float32)
+            self._flat_source = None
+        if flat is not self._flat_source:
+            self._flat_source = flat
+            if flat is None:
+                self._gain = None
+            else:
+                signal = flat.astype(np.float32) - self._dark
+                self._gain = np.ones(signal.shape, np.float32)
+                good = signal > 0
+                np.divide(np.mean(signal[good]), signal, out=self._gain, where=good)
+
+    def apply(self, frame, dark, flat=None):
+        frame = np.asarray(frame)
+        self._prepare(frame, dark, flat)
+        dtype = np.int32 if self._gain is None and frame.dtype.kind in "iub" and self._dark.dtype == np.int32 else np.float32
+        out = np.subtract(frame, self._dark, dtype=dtype, casting="unsafe")
+        if self._gain is not None:
+            out *= self._gain
+        return out
+
+
+
+def robust_background(stack, method="median", sigma=3., iterations=5):
+    """
+    Background and per-pixel noise from a stack of M frames (first axis), rejecting
+    outliers such as cosmic rays.
+
+    "median": the per-pixel median, with the noise from the median absolute deviation.
+    "sigma clip": the mean and standard deviation of each pixel after repeatedly dropping
+    values more than `sigma` standard deviations from the centre (the median on the first pass).
+
+    Returns float32 ``(background, noise)``.
+    """
+    data = np.asarray(stack, np.float32)
+    centre = np.median(data, axis=0)
+    deviation = np.abs(data - centre)
+    # 1.4826 MAD is the standard deviation for Gaussian noise
+    noise = 1.4826 * np.median(deviation, axis=0)
+    if method == "median":
+        return centre, noise
+    if method != "sigma clip":
+        raise ValueError(f"Unknown background method {method}")
+    keep = np.ones(data.shape, bool)
+    for i in range(iterations):
+        new_keep = deviation <= sigma * np.maximum(noise, 1e-6)
+        if i and np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+        n = np.maximum(keep.sum(axis=0), 1)
+        centre = np.sum(data, axis=0, where=keep) / n
+        np.abs(data - centre, out=deviation)
+        noise = np.sqrt(np.sum(deviation**2, axis=0, where=keep) / np.maximum(n - 1, 1))
+    return centre.astype(np.float32), noise.astype(np.float32)
+
+
+class DisplayDecimator:
+    """
+    Shrinks frames for display by taking the maximum over blocks of pixels, so narrow spectral
+    lines and hot pixels stay visible. The block size is the number of frame pixels per screen
+    pixel, times an extra factor that doubles while rendering takes longer than `budget`
+    seconds (see :func:`record`) and halves again once it is well under.
+
+    Frames that need no reduction are passed through without a copy.
+    """
+
+    def __init__(self, budget=10e-3, max_extra=8):
+        self.budget = budget
+        self.max_extra = max_extra
+        self.extra = 1
+        #: Duration of the last render in seconds, and the block size it used
+        self.last = 0.
+        self.factors = (1, 1)
+
+    def reduce(self, image, pixel_size=(1., 1.)):
+        # pixel_size: frame pixels per screen pixel along (y, x)
+        fy, fx = [int(min(max(1, int(p) * self.extra), n)) for p, n in zip(pixel_size, image.shape)]
+        self.factors = (fy, fx)
+        if fy == fx == 1:
+            return image
+        h, w = image.shape[0] // fy, image.shape[1] // fx
+        # Running maximum over strided views, much faster than reshape(...).max(axis=(1, 3))
+        rows = image[0:h*fy:fy, :w*fx].copy()
+        for i in range(1, fy):
+            np.maximum(rows, image[i:h*fy:fy, :w*fx], out=rows)
+        reduced = rows[:, 0::fx].copy()
+        for j in range(1, fx):
+            np.maximum(reduced, rows[:, j::fx], out=reduced)
+        return reduced
+
+    def record(self, elapsed):
+        self.last = elapsed
+        if elapsed > self.budget and self.extra < self.max_extra:
+            self.extra *= 2
+        elif elapsed < self.budget / 4 and self.extra > 1:
+            self.extra //= 2
+
+
+class Settler:
+    """
+    Waits for hardware to become ready by polling a `ready` callable every `interval` seconds,
+    rather than sleeping for a fixed time, and fails after `timeout` seconds.
+
+    The time each wait took is recorded per label in `stats` as ``[count, total, max]``,
+    with the most recent one in `last`, so the real settle times can be checked.
+    """
+
+    def __init__(self, timeout=10., interval=1e-3):
+        self.timeout = timeout
+        self.interval = interval
+        self.stats = {}
+        self.last = 0.
+
+    def _record(self, label, elapsed):
+        count, total, longest = self.stats.get(label, (0, 0., 0.))
+        self.stats[label] = [count + 1, total + elapsed, max(longest, elapsed)]
+        self.last = elapsed
+
+    def wait(self, ready, label="settle", timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        t_start = time.perf_counter()
+        while not ready():
+            if time.perf_counter() - t_start > timeout:
+                self._record(label, time.perf_counter() - t_start)
+                raise TimeoutError(f"{label}: device not ready after {timeout:.1f} s")
+            time.sleep(self.interval)
+        elapsed = time.perf_counter() - t_start
+        self._record(label, elapsed)
+        return elapsed
+
+    def summary(self):
+        return "\n".join(f"{label}: {count} waits, mean {total/count*1e3:.1f} ms, max {longest*1e3:.1f} ms"
+                         for label, (count, total, longest) in self.stats.items())
+
+
+class ParamCache:
+    """
+    Read-through cache for the device settings of a piece, using each param's stored value
+    as the cached copy.
+
+    Getters wrapped with :func:`read_through` query the device as before, but while the cache
+    is :func:`trusted` they return the stored value instead, as long as it has been read or set
+    since it was last invalidated. Setters that change other settings on the device should
+    :func:`invalidate` them.
+    """
+
+    def __init__(self):
+        self.valid = set()
+        self.registered = set()
+        self._trusted = 0
+        self._lock = threading.Lock()
+        #: Getter calls answered from the stored value, and calls that went to the device
+        self.hits = 0
+        self.reads = 0
+
+    @contextlib.contextmanager
+    def trusted(self):
+        with self._lock:
+            self._trusted += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._trusted -= 1
+
+    def read_through(self, name, params):
+        # Decorator for the getter of params[name]
+        self.registered.add(name)
+        def decorator(getter):
+            @functools.wraps(getter)
+            def wrapper(*args, **kwargs):
+                if self._trusted and name in self.valid:
+                    self.hits += 1
+                    return params[name].value
+                value = getter(*args, **kwargs)
+                self.reads += 1
+                self.valid.add(name)
+                return value
+            return wrapper
+        return decorator
+
+    def validate(self, *names):
+        # For setters that return the new value, so the getter is not called after them
+        self.valid.update(names)
+
+    def invalidate(self, *names):
+        # Everything if no names are given
+        if names:
+            self.valid.difference_update(names)
+        else:
+            self.valid.clear()
+
+    def covers(self, names):
+        # True if trusted reads of all `names` would need no device access
+        return all(name in self.valid or name not in self.registered for name in names)
+
+
+class CalibrationCache:
+    """
+    Least-recently-used cache of calibration arrays (such as a spectrometer wavelength axis),
+    keyed by a tuple of the settings the calibration depends on.
+
+    :func:`get` returns the cached array, or calls `compute` on a miss. With a `path`, entries are
+    also kept in a small .npz store, so they survive restarts of the GUI. The store holds at most
+    `disk_size` entries and is rewritten on every miss, which is cheap at that size.
+    """
+
+    def __init__(self, path=None, maxsize=32, disk_size=256):
+        self.path = path
+        self.maxsize = int(maxsize)
+        self.disk_size = int(disk_size)
+        self._memory = OrderedDict()
+        self._disk = None
+        self._lock = threading.Lock()
+        #: Lookups answered from memory, from the disk store, and by calling `compute`
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _load_disk(self):
+        if self._disk is None:
+            self._disk = OrderedDict()
+            if self.path is not None and os.path.exists(self.path):
+                try:
+                    with np.load(self.path) as store:
+                        for name in store.files:
+                            self._disk[name] = store[name]
+                except Exception as e:
+                    warnings.warn(f"Ignoring unreadable calibration cache {self.path}: {e}")
+        return self._disk
+
+    def _save_disk(self):
+        while len(self._disk) > self.disk_size:
+            self._disk.popitem(last=False)
+        buffer = io.BytesIO()
+        np.savez(buffer, **self._disk)
+        # Write to a temporary file first so a crash can't leave a truncated store
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(self.path + ".tmp", self.path)
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            name = repr(key)
+            disk = self._load_disk() if self.path is not None else None
+            if disk is not None and name in disk:
+                value = disk[name]
+                self.disk_hits += 1
+            else:
+                value = np.asarray(compute())
+                self.misses += 1
+                if disk is not None:
+                    disk[name] = value
+                    try:
+                        self._save_disk()
+                    except OSError as e:
+                        warnings.warn(f"Could not write the calibration cache {self.path}: {e}")
+            self._memory[key] = value
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+            return value
+
+    def clear(self):
+        # Forget every entry, in memory and on disk
+        with self._lock:
+            self._memory.clear()
+            self._disk = OrderedDict()
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def stats(self):
+        return f"{self.hits} hits, {self.disk_hits} from disk, {self.misses} misses"
+
+class BeamProfiler:
+    """
+    Beam position and size from camera frames: the centroid, the D4σ widths (four times the
+    standard deviation of the intensity) along x and y, their ratio as the ellipticity, and the
+    brightest pixel. All in pixels.
+
+    The moments come from the row and column sums, accumulated as integers for integer frames,
+    so the frame is never copied to floats. The mean of the frame border is taken as the
+    background level and subtracted from the sums, so the beam should sit inside the ROI.
+    Widths are along the x and y axes, not the principal axes of a rotated beam.
+
+    Every measurement is also written to a preallocated history of `length` entries, which
+    :func:`history` returns in time order.
+    """
+    FIELDS = ("time", "x", "y", "d4s_x", "d4s_y", "ellipticity", "peak_x", "peak_y", "peak")
+
+    def __init__(self, length=100000):
+        self._history = np.zeros(length, [(name, np.float64) for name in self.FIELDS])
+        self._lock = threading.Lock()
+        self._coords = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._count = 0
+            #: The latest measurement as a dict, None until the first frame
+            self.last = None
+
+    def _moments(self, projection, offset):
+        n = len(projection)
+        if n not in self._coords:
+            self._coords[n] = np.arange(n, dtype=np.float64)
+        coords = self._coords[n]
+        weights = np.clip(projection - offset, 0, None)
+        total = weights.sum()
+        if total <= 0:
+            return np.nan, np.nan
+        centre = coords @ weights / total
+        return centre, 4 * np.sqrt((coords - centre)**2 @ weights / total)
+
+    def measure(self, image, t=None):
+        image = np.asarray(image)
+        dtype = np.int64 if image.dtype.kind in "ui" else np.float64
+        h, w = image.shape
+        border = (image[0].sum(dtype=dtype) + image[-1].sum(dtype=dtype)
+                  + image[1:-1, 0].sum(dtype=dtype) + image[1:-1, -1].sum(dtype=dtype))
+        offset = border / (2*w + 2*(h - 2))
+        x, d4s_x = self._moments(image.sum(axis=0, dtype=dtype), offset * h)
+        y, d4s_y = self._moments(image.sum(axis=1, dtype=dtype), offset * w)
+        peak_y, peak_x = divmod(int(np.argmax(image)), w)
+        ellipticity = min(d4s_x, d4s_y) / max(d4s_x, d4s_y) if d4s_x > 0 and d4s_y > 0 else np.nan
+        row = (time.time() if t is None else t, x, y, d4s_x, d4s_y, ellipticity,
+               peak_x, peak_y, image[peak_y, peak_x] - offset)
+        with self._lock:
+            self._history[self._count % len(self._history)] = row
+            self._count += 1
+            self.last = dict(zip(self.FIELDS, (float(v) for v in row)))
+        return self.last
+
+    def history(self):
+        with self._lock:
+            n = min(self._count, len(self._history))
+            start = self._count % len(self._history) if self._count > len(self._history) else 0
+            return np.concatenate((self._history[start:n], self._history[:start]))
+
+
+if __name__ == "__main__":
+    # Per-frame cost of the background subtraction. The dark-only case costs about the same as
+    # casting both frames each time, what BackgroundCorrector saves is the flat-field gain,
+    # which "dark + flat, uncached" works out again for every frame
+    import timeit
+    rng = np.random.default_rng()
+    for name, shape, dtype in (("Andor 1024x256", (256, 1024), np.uint16),
+                               ("Basler 640x480", (480, 640), np.uint8)):
+        frame = rng.integers(0, 1000 if dtype == np.uint16 else 255, shape).astype(dtype)
+        dark = rng.integers(0, 100, shape).astype(dtype)
+        flat = rng.integers(100, 255, shape).astype(dtype)
+        corrector = BackgroundCorrector()
+        background = dark.astype(np.int32)
+        def uncached(frame, dark, flat):
+            signal = flat.astype(np.float32) - dark
+            good = signal > 0
+            gain = np.ones(signal.shape, np.float32)
+            np.divide(np.mean(signal[good]), signal, out=gain, where=good)
+            return (frame.astype(np.float32) - dark) * gain
+        for label, f in (("astype", lambda: frame.astype(np.int32) - dark.astype(np.int32)),
+                         ("astype, cached", lambda: frame.astype(np.int32) - background),
+                         ("dark", lambda: corrector.apply(frame, dark)),
+                         ("dark + flat, uncached", lambda: uncached(frame, dark, flat)),
+                         ("dark + flat", lambda: corrector.apply(frame, dark, flat))):
+            timer = timeit.Timer(f)
+            n = timer.autorange()[0]
+            t = min(timer.repeat(5, n)) / n
+            print(f"{name:15s} {label:22s} {t*1e6:8.1f} us/frame")
+
+    # Beam analysis on a Basler-sized frame, with a Gaussian spot on a dark level
+    yy, xx = np.mgrid[:480, :640]
+    spot = (20 + 200*np.exp(-((xx - 300)**2/(2*30**2) + (yy - 200)**2/(2*15**2)))).astype(np.uint8)
+    profiler = BeamProfiler()
+    timer = timeit.Timer(lambda: profiler.measure(spot))
+    n = timer.autorange()[0]
+    t = min(timer.repeat(5, n)) / n
+    last = profiler.last
+    print(f"Beam profile 640x480 {t*1e6:8.1f} us/frame, centre ({last['x']:.1f}, {last['y']:.1f}), "
+          f"D4σ ({last['d4s_x']:.1f}, {last['d4s_y']:.1f}), expected (300, 200) and (120, 60)")
@@ -0,0 +1,196 @@
+from pyqtgraph.Qt import QtCore
+import numpy as np
+import collections
+import time
+import weakref
+
+# Live display scheduling shared by the camera pieces (Andor, Basler).
+# Frames can arrive far faster than they can be drawn, so instead of redrawing on every
+# frame, each display is marked as stale and redrawn at most at its own maximum rate by a
+# single timer on the GUI thread, always with the latest frame.
+
+
+class RateCounter:
+    """
+    Events per second over the last `window` seconds, for counting frames from any thread.
+    """
+
+    def __init__(self, window=1., maxlen=256):
+        self.window = window
+        self._times = collections.deque(maxlen=maxlen)
+
+    def tick(self):
+        self._times.append(time.perf_counter())
+
+    def rate(self):
+        now = time.perf_counter()
+        times = [t for t in list(self._times) if now - t < self.window]
+        if len(times) < 2:
+            return 0.
+        return (len(times) - 1) / (times[-1] - times[0])
+
+
+class DisplayView:
+    """
+    One live display registered with a :class:`DisplayScheduler`. Call :func:`frame` for
+    every acquired frame and :func:`request` for other changes that need a redraw (crosshairs
+    moved, etc.); `render` is then called on the GUI thread at most `max_fps` times a second.
+    `max_fps` can also be a callable returning the rate, such as a param's value.
+    The optional `on_stats` is called after a render at most every `stats_interval` seconds,
+    for updating rate readouts.
+    """
+
+    def __init__(self, render, max_fps=30., on_stats=None, stats_interval=0.5):
+        self.render = render
+        self.max_fps = max_fps
+        self.on_stats = on_stats
+        self.stats_interval = stats_interval
+        self._stats_time = 0.
+        self.acquired = RateCounter()
+        self.displayed = RateCounter()
+        self._stale = False
+        self._last = 0.
+        # Set by DisplayScheduler.register
+        self._scheduler = None
+
+    def frame(self, *args):
+        self.acquired.tick()
+        self._mark_stale()
+
+    def request(self, *args):
+        self._mark_stale()
+
+    def _mark_stale(self):
+        if not self._stale:
+            self._stale = True
+            if self._scheduler is not None:
+                self._scheduler._wake.emit()
+
+    def _due(self, now):
+        max_fps = self.max_fps() if callable(self.max_fps) else self.max_fps
+        return self._stale and now - self._last >= 1 / max(max_fps or 30., 1e-3)
+
+    def acquisition_fps(self):
+        return self.acquired.rate()
+
+    def display_fps(self):
+        return self.displayed.rate()
+
+
+class DisplayScheduler(QtCore.QObject):
+    """
+    Redraws the registered :class:`DisplayView` objects from a single QTimer ticking every
+    `interval` seconds, so the drawing cost no longer sets the acquisition rate. The timer
+    only runs while a view is waiting to be redrawn. Use :func:`for_puzzle` to get the
+    scheduler shared by all pieces of a Puzzle.
+    """
+    _shared = weakref.WeakKeyDictionary()
+    # Emitted when a view goes stale, which may be on a worker thread
+    _wake = QtCore.pyqtSignal()
+
+    def __init__(self, interval=5e-3):
+        super().__init__()
+        self._views = []
+        self._timer = QtCore.QTimer(self)
+        self._timer.setTimerType(QtCore.Qt.TimerType.PreciseTimer)
+        self._timer.setInterval(int(interval * 1e3))
+        self._timer.timeout.connect(self._tick)
+        self._wake.connect(self._start)
+
+    @classmethod
+    def for_puzzle(cls, puzzle):
+        if puzzle not in cls._shared:
+            cls._shared[puzzle] = cls()
+        return cls._shared[puzzle]
+
+    def register(self, render, max_fps=30., on_stats=None):
+        view = DisplayView(render, max_fps, on_stats)
+        view._scheduler = self
+        self._views.append(view)
+        return view
+
+    def unregister(self, view):
+        if view in self._views:
+            self._views.remove(view)
+            view._scheduler = None
+        if not self._views:
+            self._timer.stop()
+
+    def _start(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _tick(self):
+        now = time.perf_counter()
+        error = None
+        for view in self._views:
+            if not view._due(now):
+                continue
+            view._stale = False
+            view._last = now
+            try:
+                view.render()
+                view.displayed.tick()
+                if view.on_stats is not None and now - view._stats_time > view.stats_interval:
+                    view._stats_time = now
+                    view.on_stats()
+            except Exception as e:
+                # One failing display should not hold up the others
+                error = error or e
+        # Views marked stale from now on start the timer again
+        if not any(view._stale for view in self._views):
+            self._timer.stop()
+        if error is not None:
+            raise error
+
+
+class UniformGrid:
+    """
+    Draws maps over non-uniform axes (wavelength, pump power) as a single ImageItem with the
+    real axis values. Each axis is resampled onto a uniform grid by nearest neighbour, using
+    index tables built once per axis and kept for the next redraws, so an update is one
+    indexing pass instead of a NonUniformImage rectangle per pixel or a contour plot.
+    Axes that are already uniform and in order are drawn as they are.
+    """
+
+    def __init__(self, oversample=2, maxsize=8):
+        # Grid points per data point at most, where the finest step would need more
+        self.oversample = oversample
+        self.maxsize = maxsize
+        self._tables = collections.OrderedDict()
+
+    def _table(self, axis):
+        key = (len(axis), hash(axis.tobytes()))
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        order = np.argsort(axis, kind="stable")
+        ordered = axis[order]
+        start, stop, n = ordered[0], ordered[-1], len(axis)
+        steps = np.diff(ordered)
+        if n < 2 or stop <= start:
+            index = None
+        elif np.allclose(steps, (stop - start) / (n - 1), rtol=1e-3):
+            index = None if np.array_equal(order, np.arange(n)) else order
+        else:
+            n = int(min(np.ceil((stop - start) / steps[steps > 0].min()) + 1, self.oversample * n))
+            grid = np.linspace(start, stop, n)
+            index = order[np.searchsorted((ordered[1:] + ordered[:-1]) / 2, grid)]
+        # Pixel edges, half a grid step either side of the first and last point
+        step = (stop - start) / (n - 1) if n > 1 and stop > start else 1.
+        table = (index, (start - step/2, stop - start + step))
+        self._tables[key] = table
+        if len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+        return table
+
+    def resample(self, image, x, y):
+        """
+        `image` of shape (len(y), len(x)) on a uniform grid, and the QRectF it covers in axis units.
+        """
+        (ix, (x0, width)), (iy, (y0, height)) = self._table(np.asarray(x, float)), self._table(np.asarray(y, float))
+        if iy is not None:
+            image = image[iy]
+        if ix is not None:
+            image = image[:, ix]
+        return image, QtCore.QRectF(x0, y0, width, height)
@@ -0,0 +1,183 @@
+import numpy as np
+import time
+import threading
+import bisect
+from collections import namedtuple
+
+# Simulated Andor camera used by the Andor piece in debug mode.
+# Mirrors the subset of pylablib's AndorSDK2Camera that the pieces use, so the
+# acquisition engines can be exercised and benchmarked without hardware.
+
+TFramesStatus = namedtuple("TFramesStatus", ["acquired", "unread", "skipped", "buffer_size"])
+
+
+class SimAndorCamera:
+    TimeoutError = TimeoutError
+
+    def __init__(self, shape=(256, 1024), exposure=0.1, readout_time=5e-3, buffer_size=64, scene=None):
+        self.exposure = exposure
+        # Time to shift and digitise one frame, added to the exposure for the kinetic period
+        self.readout_time = readout_time
+        self.buffer_size = buffer_size
+        # Optional callable scene(shape, t) returning the noise-free frame for an exposure
+        # starting at time t (time.perf_counter), so the scene can follow other simulated devices
+        self.scene = scene
+        self._acq_mode = "single"
+        self._trigger_mode = "int"
+        self._nframes = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng()
+        self._snaps = 0
+        self._snapping = False
+        self.set_shape(shape)
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self._t_start = time.perf_counter()
+        self._pulse_times = []
+        self._read = 0
+        self._skipped = 0
+
+    def set_shape(self, shape):
+        self.shape = tuple(int(x) for x in shape)
+        # A small bank of noise frames keeps the simulated readout cheap
+        self._bank = self._rng.poisson(100, (4, *self.shape)).astype(np.uint16)
+
+    ### Settings ###
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+
+    def get_exposure(self):
+        return self.exposure
+
+    def get_frame_period(self):
+        return self.exposure + self.readout_time
+
+    def set_acquisition_mode(self, mode):
+        self._acq_mode = mode
+
+    def get_acquisition_mode(self):
+        return self._acq_mode
+
+    def setup_kinetic_mode(self, num_cycle, *args, **kwargs):
+        self._acq_mode = "kinetic"
+        self._nframes = int(num_cycle)
+
+    def setup_acquisition(self, mode=None, nframes=None):
+        if mode == "kinetic" and nframes is not None:
+            self.setup_kinetic_mode(nframes)
+        elif mode is not None:
+            self.set_acquisition_mode(mode)
+
+    def set_trigger_mode(self, mode):
+        self._trigger_mode = mode
+
+    def get_trigger_mode(self):
+        return self._trigger_mode
+
+    ### Acquisition ###
+    def start_acquisition(self):
+        with self._lock:
+            self._reset_counters()
+            self._running = True
+
+    def stop_acquisition(self):
+        with self._lock:
+            self._running = False
+
+    def clear_acquisition(self):
+        self.stop_acquisition()
+
+    def get_status(self):
+        return "acquiring" if self._running or self._snapping else "idle"
+
+    def acquisition_in_progress(self):
+        return self.get_status() == "acquiring"
+
+    def trigger(self, n=1, interval=0.):
+        # External trigger input: n pulses spaced by interval seconds. Pulses arriving
+        # during an exposure/readout are ignored, as on the real detector.
+        t = time.perf_counter()
+        period = self.get_frame_period()
+        with self._lock:
+            if not self._running or self._trigger_mode != "ext":
+                return
+            for i in range(int(n)):
+                if not self._pulse_times or t - self._pulse_times[-1] >= period:
+                    self._pulse_times.append(t)
+                t += interval
+
+    def _acquired(self):
+        now = time.perf_counter()
+        period = self.get_frame_period()
+        if self._trigger_mode == "ext":
+            acquired = bisect.bisect_right(self._pulse_times, now - period)
+        else:
+            acquired = int((now - self._t_start) / period)
+        if self._acq_mode == "kinetic" and self._nframes is not None:
+            acquired = min(acquired, self._nframes)
+        return acquired
+
+    def _exposure_time(self, idx):
+        if self._trigger_mode == "ext":
+            return self._pulse_times[idx]
+        return self._t_start + idx * self.get_frame_period()
+
+    def _make_frame(self, idx, t):
+        frame = self._bank[idx % len(self._bank)]
+        if self.scene is not None:
+            return np.clip(frame + self.scene(self.shape, t), 0, 65535).astype(np.uint16)
+        return frame.copy()
+
+    def get_frames_status(self):
+        with self._lock:
+            acquired = self._acquired() if self._running else self._read
+            return TFramesStatus(acquired, acquired - self._read, self._skipped, self.buffer_size)
+
+    def wait_for_frame(self, since="lastread", nframes=1, timeout=20.):
+        t_end = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            if not self._running:
+                return False
+            with self._lock:
+                if self._acquired() >= self._read + nframes:
+                    return True
+            if t_end is not None and time.perf_counter() > t_end:
+                raise self.TimeoutError("Simulated camera timed out waiting for a frame")
+            time.sleep(min(1e-3, self.get_frame_period() / 10))
+
+    def read_multiple_images(self, rng=None, peek=False, missing_frame="skip", return_info=False):
+        if not self._running:
+            return None
+        with self._lock:
+            acquired = self._acquired()
+            first = self._read
+            # Frames older than the circular buffer have been written over
+            if acquired - first > self.buffer_size:
+                self._skipped += acquired - first - self.buffer_size
+                first = acquired - self.buffer_size
+            if not peek:
+                self._read = acquired
+            times = [self._exposure_time(i) for i in range(first, acquired)]
+        return [self._make_frame(i, t) for i, t in zip(range(first, acquired), times)]
+
+    def read_newest_image(self, peek=False):
+        frames = self.read_multiple_images(peek=peek)
+        if not frames:
+            return None
+        return frames[-1]
+
+    def snap(self, timeout=5.):
+        t = time.perf_counter()
+        # The camera reports "acquiring" until the frame is read out, as a real snap does
+        self._snapping = True
+        try:
+            time.sleep(self.get_frame_period())
+        finally:
+            self._snapping = False
+        self._snaps += 1
+        return self._make_frame(self._snaps, t)
+
+    def close(self):
+        self.stop_acquisition()
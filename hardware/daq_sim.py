@@ -0,0 +1,136 @@
+import numpy as np
+import time
+import threading
+import bisect
+
+# Simulated NI-DAQ used by the NIDAQ piece in debug mode.
+# Mirrors the analog/pulse output subset of pylablib's NIDAQ, plus a counter-clocked
+# analog output, so that hardware-timed sweeps can be tested without a card.
+
+
+class SimNIDAQ:
+    def __init__(self, dev_name="Dev1"):
+        self.dev_name = dev_name
+        self.ao_values = {}
+        # (times, values) of every on-demand update, so other simulated devices can
+        # look up the output at the moment they sample it
+        self._ao_history = {}
+        self._clocked = {}
+        self._pulses = {}
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._opened = True
+
+    def is_opened(self):
+        return self._opened
+
+    def close(self):
+        self._opened = False
+
+    ### Analog outputs ###
+    def add_voltage_output(self, name, channel, rng=(-10, 10), initial_value=0.):
+        self.set_voltage_outputs(name, initial_value)
+
+    def set_voltage_outputs(self, names, values):
+        if isinstance(names, str):
+            names, values = [names], [values]
+        t = time.perf_counter()
+        with self._lock:
+            for n, v in zip(names, values):
+                self.ao_values[n] = v
+                times, history = self._ao_history.setdefault(n, ([], []))
+                times.append(t)
+                history.append(v)
+
+    def _on_demand_value(self, name, t):
+        times, history = self._ao_history.get(name, ([], []))
+        i = bisect.bisect_right(times, t)
+        return history[i-1] if i else 0.
+
+    def get_voltage_outputs(self, names=None):
+        if names is None:
+            names = list(self.ao_values)
+        elif isinstance(names, str):
+            names = [names]
+        now = time.perf_counter()
+        return [self.voltage_at(n, now) for n in names]
+
+    # Clocked output: sample i is written on the falling edge of the i-th pulse
+    # of the pulse output running on `counter`
+    def setup_clocked_voltage_output(self, name, waveform, counter):
+        with self._lock:
+            self._clocked[name] = (np.asarray(waveform, float), counter)
+
+    def stop_clocked_voltage_output(self, name):
+        value = self.voltage_at(name, time.perf_counter())
+        with self._lock:
+            self._clocked.pop(name, None)
+        self.set_voltage_outputs(name, value)
+
+    # Output of `name` at time t (time.perf_counter)
+    def voltage_at(self, name, t):
+        with self._lock:
+            if name not in self._clocked:
+                return self._on_demand_value(name, t)
+            waveform, counter = self._clocked[name]
+            pulse = next((p for p in self._pulses.values() if p["counter"] == counter and p["t_start"] is not None), None)
+            if pulse is None:
+                return self._on_demand_value(name, t)
+            period = pulse["on"] + pulse["off"]
+            edges = int(np.floor((t - pulse["t_start"] - pulse["on"]) / period)) + 1
+            edges = min(edges, pulse["samps"], len(waveform))
+            if edges <= 0:
+                return self._on_demand_value(name, t)
+        return waveform[edges-1]
+
+    ### Pulse outputs ###
+    def add_pulse_output(self, name, counter, terminal, kind="time", on=1e-3, off=1e-3, clk_src=None, continuous=True, samps=1000):
+        with self._lock:
+            self._pulses[name] = {"counter": counter, "terminal": terminal, "on": on, "off": off,
+                                  "continuous": continuous, "samps": samps, "t_start": None}
+
+    def set_pulse_output(self, name, on=None, off=None, continuous=None, samps=None, terminal=None, restart=True):
+        with self._lock:
+            pulse = self._pulses[name]
+            for key, value in (("on", on), ("off", off), ("continuous", continuous), ("samps", samps), ("terminal", terminal)):
+                if value is not None:
+                    pulse[key] = value
+
+    def start_pulse_output(self, names=None, autostop=True):
+        names = list(self._pulses) if names is None else [names] if isinstance(names, str) else names
+        for name in names:
+            with self._lock:
+                pulse = self._pulses[name]
+                pulse["t_start"] = time.perf_counter()
+                n = np.inf if pulse["continuous"] else pulse["samps"]
+                period = pulse["on"] + pulse["off"]
+            if np.isfinite(n):
+                for callback in self._listeners.get(name, []):
+                    callback(n, period)
+
+    def stop_pulse_output(self, names=None):
+        names = list(self._pulses) if names is None else [names] if isinstance(names, str) else names
+        with self._lock:
+            for name in names:
+                self._pulses[name]["t_start"] = None
+
+    def is_pulse_output_running(self, names=None):
+        if names is None:
+            return {n: self.is_pulse_output_running(n) for n in self._pulses}
+        if not isinstance(names, str):
+            return {n: self.is_pulse_output_running(n) for n in names}
+        pulse = self._pulses[names]
+        if pulse["t_start"] is None:
+            return False
+        if pulse["continuous"]:
+            return True
+        return time.perf_counter() < pulse["t_start"] + pulse["samps"] * (pulse["on"] + pulse["off"])
+
+    # Stands in for the cable from the counter's PFI terminal to a trigger input:
+    # callback(n, period) is called when a finite pulse train starts
+    def connect_pulse_output(self, name, callback):
+        self._listeners.setdefault(name, []).append(callback)
+
+    def disconnect_pulse_output(self, name, callback):
+        if callback in self._listeners.get(name, []):
+            self._listeners[name].remove(callback)
@@ -0,0 +1,147 @@
+import numpy as np
+
+# Batch analysis of light-in/light-out scans: every spectrum of a (power, wavelength) matrix
+# at once, with no Python loop over spectra. Used by ll_viewer_onsite.
+
+
+def peak_analysis(spectra, wl):
+    """
+    Main peak of every row of `spectra` (shape (N, len(wl))), as a dict of arrays of length N:
+
+    - ``index``: pixel of the highest point
+    - ``wavelength``: peak wavelength, refined to a fraction of a pixel with a parabola
+      through the highest point and its neighbours
+    - ``height``: peak height above the baseline (the row minimum)
+    - ``fwhm``: full width at half maximum, from the linearly interpolated half-maximum
+      crossings either side of the peak; NaN if the peak runs off the spectrum
+    - ``smsr``: side-mode suppression ratio in dB, the main peak over the highest other
+      local maximum outside the main mode (its half-maximum width either side of it);
+      inf if there is no side mode above the baseline
+    """
+    spectra = np.asarray(spectra, float)
+    wl = np.asarray(wl, float)
+    n, w = spectra.shape
+    rows = np.arange(n)
+    pixels = np.arange(w)
+
+    index = np.argmax(spectra, axis=1)
+    peak = spectra[rows, index]
+    baseline = spectra.min(axis=1)
+    height = peak - baseline
+
+    # Sub-pixel peak position from the parabola through the three highest points
+    inner = np.clip(index, 1, w - 2)
+    a, b, c = spectra[rows, inner - 1], spectra[rows, inner], spectra[rows, inner + 1]
+    curvature = a - 2*b + c
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shift = np.where(curvature < 0, 0.5 * (a - c) / curvature, 0.)
+    position = np.where(index == inner, inner + np.clip(shift, -0.5, 0.5), index)
+    wavelength = np.interp(position, pixels, wl)
+
+    # Last pixel below half maximum left of the peak, first one right of it
+    half = baseline + height / 2
+    below = spectra < half[:, None]
+    left_of_peak = pixels < index[:, None]
+    left_mask = below & left_of_peak
+    right_mask = below & ~left_of_peak & (pixels > index[:, None])
+    has_left, has_right = left_mask.any(axis=1), right_mask.any(axis=1)
+    left = np.where(has_left, w - 1 - np.argmax(left_mask[:, ::-1], axis=1), 0)
+    right = np.where(has_right, np.argmax(right_mask, axis=1), w - 1)
+
+    def crossing(i, j):
+        # Wavelength where the spectrum crosses half maximum between pixels i and j
+        yi, yj = spectra[rows, i], spectra[rows, j]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(yj != yi, (half - yi) / (yj - yi), 0.)
+        return wl[i] + fraction * (wl[j] - wl[i])
+
+    left_wl = crossing(left, np.minimum(left + 1, w - 1))
+    right_wl = crossing(np.maximum(right - 1, 0), right)
+    fwhm = np.where(has_left & has_right, np.abs(right_wl - left_wl), np.nan)
+
+    # Highest local maximum outside the main mode
+    local_max = np.zeros_like(below)
+    local_max[:, 1:-1] = (spectra[:, 1:-1] > spectra[:, :-2]) & (spectra[:, 1:-1] >= spectra[:, 2:])
+    width = right - left
+    main_mode = (pixels >= (left - width)[:, None]) & (pixels <= (right + width)[:, None])
+    side = np.where(local_max & ~main_mode, spectra, -np.inf).max(axis=1) - baseline
+    with np.errstate(divide="ignore", invalid="ignore"):
+        smsr = np.where(side > 0, 10 * np.log10(height / side), np.inf)
+
+    return {"index": index, "wavelength": wavelength, "height": height, "fwhm": fwhm, "smsr": smsr}
+
+
+def lasing_threshold(power, output):
+    """
+    Lasing threshold of an L-I curve, as the `power` where two straight lines fitted below
+    and above it cross. Every split point is tried at once using cumulative sums, and the one
+    with the smallest total squared error is kept. Returns (threshold, slope above threshold).
+    """
+    order = np.argsort(power)
+    x, y = np.asarray(power, float)[order], np.asarray(output, float)[order]
+    n = len(x)
+    if n < 4:
+        return np.nan, np.nan
+
+    def fits(x, y):
+        # Least-squares lines through the first k points, for every k
+        k = np.arange(1, len(x) + 1)
+        sx, sy, sxx, sxy, syy = (np.cumsum(v) for v in (x, y, x*x, x*y, y*y))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (k*sxy - sx*sy) / (k*sxx - sx**2)
+            intercept = (sy - slope*sx) / k
+            sse = syy - 2*slope*sxy - 2*intercept*sy + slope**2*sxx + 2*slope*intercept*sx + k*intercept**2
+        return slope, intercept, sse
+
+    below = fits(x, y)
+    above = [v[::-1] for v in fits(x[::-1], y[::-1])]
+    # Split after point k-1: k points below, at least two on each side
+    k = np.arange(2, n - 1)
+    total = below[2][k - 1] + above[2][k]
+    best = k[np.nanargmin(total)]
+    s1, c1 = below[0][best - 1], below[1][best - 1]
+    s2, c2 = above[0][best], above[1][best]
+    if s2 == s1:
+        return np.nan, s2
+    return (c1 - c2) / (s2 - s1), s2
+
+
+def synthetic_spectra(n=10000, w=1024, seed=0):
+    """
+    `n` noisy laser spectra over `w` pixels of 800-900 nm: a Lorentzian main mode with a
+    random centre and width, a weaker side mode and a flat background. Returns the
+    spectra, the wavelength axis and the true centres and widths.
+    """
+    rng = np.random.default_rng(seed)
+    wl = np.linspace(800, 900, w)
+    centre = rng.uniform(830, 870, n)
+    width = rng.uniform(0.3, 3., n)
+    side = centre + rng.choice([-1, 1], n) * rng.uniform(8, 15, n)
+    x = wl[None, :]
+    spectra = (1000 / (1 + ((x - centre[:, None]) / (width[:, None]/2))**2)
+               + 20 / (1 + ((x - side[:, None]) / 0.5)**2)
+               + 50 + rng.normal(0, 1, (n, w)))
+    return spectra, wl, centre, width
+
+
+if __name__ == "__main__":
+    # 10k synthetic spectra, vectorized against the same analysis one spectrum at a time
+    import time
+    spectra, wl, centre, width = synthetic_spectra()
+    t = time.perf_counter()
+    result = peak_analysis(spectra, wl)
+    t_batch = time.perf_counter() - t
+    t = time.perf_counter()
+    for row in spectra[:500]:
+        peak_analysis(row[None, :], wl)
+    t_loop = (time.perf_counter() - t) / 500 * len(spectra)
+    print(f"{len(spectra)} spectra: {t_batch*1e3:.0f} ms batched, ~{t_loop*1e3:.0f} ms one at a time")
+    print(f"Peak error {np.abs(result['wavelength'] - centre).max()*1e3:.1f} pm max, "
+          f"FWHM error {np.nanmedian(np.abs(result['fwhm'] - width)/width)*100:.1f} % median, "
+          f"SMSR {np.median(result['smsr']):.1f} dB median")
+
+    power = np.linspace(0, 5, 60)
+    output = 0.02*power + 0.03*np.logaddexp(0, (power - 2.2)/0.03) + np.random.default_rng(1).normal(0, 0.005, 60)
+    t = time.perf_counter()
+    threshold, slope = lasing_threshold(power, output)
+    print(f"Threshold {threshold:.3f} (expected 2.2), slope {slope:.3f}, {(time.perf_counter() - t)*1e3:.2f} ms")
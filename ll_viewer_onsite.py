@@ -1,16 +1,224 @@
 import puzzlepiece as pzp
 import pyqtgraph as pg
-from pyqtgraph.Qt import QtWidgets
+from pyqtgraph.Qt import QtWidgets, QtCore
 from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
 import numpy as np
 import datasets as ds
-from scipy.io import loadmat
-import mat73
+from scipy.io import loadmat, whosmat
+import h5py
+import concurrent.futures
+import collections
+import os
+
+import display_tools
+import ll_analysis
+
+# Raw spectra are read and reduced in blocks of about this many bytes, see reduce_blocks
+BLOCK_BYTES = 64 * 2**20
+
+# Per-spectrum results of ll_analysis.peak_analysis offered by the "Analysis plot" dropdown
+ANALYSIS_PLOTS = {"Peak wavelength": "wavelength", "FWHM": "fwhm", "SMSR": "smsr"}
+
+
+class LazyArray:
+    """
+    A MATLAB v7.3 (HDF5) variable, read from the file only when sliced. HDF5 stores MATLAB
+    arrays with the axes reversed, so the axes are flipped back here, as mat73 does.
+    The last axis is contiguous in the file, so that's the one to read blocks along.
+    """
+    def __init__(self, dataset):
+        self._dataset = dataset
+        self.shape = dataset.shape[::-1]
+        self.dtype = dataset.dtype
+        self.ndim = dataset.ndim
+        self.size = dataset.size
+        self.block_axis = self.ndim - 1
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),) * (self.ndim - len(index))
+        return self._dataset[index[::-1]].T
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._dataset[()].T, dtype)
+
+    def reshape(self, *shape):
+        return np.asarray(self).reshape(*shape)
+
+
+class MatFile:
+    """
+    Variables of a .mat file, read when first used rather than when the file is opened.
+    v7.3 files give :class:`LazyArray` objects. Older files can't be read in parts, so each
+    variable is loaded whole on first access, but only the ones that are used.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._loaded = {}
+        if h5py.is_hdf5(path):
+            self._file = h5py.File(path, "r")
+            self._names = [k for k, v in self._file.items() if isinstance(v, h5py.Dataset)]
+        else:
+            self._file = None
+            self._names = [name for name, shape, kind in whosmat(path)]
+
+    def keys(self):
+        return list(self._names)
+
+    def get(self, name):
+        if name not in self._names:
+            return None
+        if name not in self._loaded:
+            if self._file is not None:
+                self._loaded[name] = LazyArray(self._file[name])
+            else:
+                self._loaded[name] = loadmat(self.path, variable_names=[name])[name]
+        return self._loaded[name]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def reduce_blocks(spectra, unused_axes, block_bytes=BLOCK_BYTES):
+    """
+    Sum `spectra` over `unused_axes`, one block at a time along the array's ``block_axis``
+    (0 unless it says otherwise), so memory-mapped or lazily read data is never all in
+    memory at once. The background is subtracted afterwards, see :func:`subtract_background`.
+    """
+    axis = getattr(spectra, "block_axis", 0)
+    n = spectra.shape[axis]
+    step = max(1, int(block_bytes // (spectra.size // n * 8 or 1)))
+    out_axis = axis - sum(1 for i in unused_axes if i < axis)
+    result = None
+    for start in range(0, n, step):
+        index = [slice(None)] * len(spectra.shape)
+        index[axis] = slice(start, start + step)
+        block = np.asarray(spectra[tuple(index)])
+        if unused_axes:
+            block = block.sum(axis=tuple(unused_axes))
+        if axis in unused_axes:
+            result = block if result is None else result + block
+            continue
+        if result is None:
+            shape = list(block.shape)
+            shape[out_axis] = n
+            result = np.empty(shape, block.dtype)
+        out_index = [slice(None)] * result.ndim
+        out_index[out_axis] = slice(start, start + step)
+        result[tuple(out_index)] = block
+    return result
+
+
+def subtract_background(total, summed, background):
+    """
+    Subtract `background` once for each of the `summed` frames in the `total` spectra. The sum is
+    linear, so this is the same as subtracting it from each frame before summing. Integer counts
+    are worked out as int64, so spectra below the background go negative instead of wrapping around.
+    """
+    background = np.asarray(background)
+    if total.dtype.kind in "ui" and background.dtype.kind in "ui":
+        dtype = np.int64
+    else:
+        dtype = np.result_type(total.dtype, background.dtype)
+    return total.astype(dtype) - summed * background.astype(dtype)[np.newaxis, ...]
+
+
+def unused_axes(shape, used_axes):
+    # Axes of an array with the given shape not covered by the used axes (wavelength, power)
+    used_sizes = {ax.size for ax in used_axes}
+    return [i for i, size in enumerate(shape) if size not in used_sizes]
+
+
+def open_file(path):
+    # A .ds dataset, or a .mat file read lazily
+    match path.split('.')[-1]:
+        case "ds": return ds.load(path)
+        case "mat": return MatFile(path)
+        case _: raise Exception("File type invalid")
+
+
+def read_arrays(dat, datatype, data_var, wl_var, power_var, bg_var):
+    """
+    Spectra, wavelength, power and background of an opened file, by variable name. The
+    spectra of .mat files are left in the file to be read in blocks by :func:`reduce_blocks`.
+    """
+    match datatype:
+        case "ds":
+            return dat.raw, dat.axis(wl_var), dat.axis(power_var), dat.metadata.get(bg_var)
+        case "mat":
+            wl, power, bg = [None if dat.get(name) is None else np.asarray(dat.get(name)).reshape(-1)
+                             for name in (wl_var, power_var, bg_var)]
+            return dat.get(data_var), wl, power, bg
+        case _: raise Exception("File type invalid")
+
+
+def compile_file(path, data_var, wl_var, power_var, bg_var, sub_bg):
+    """
+    Load, reduce and analyse one file from start to finish, as the viewer's Compile does.
+    Runs in the processes of :class:`Batch`, so it only takes and returns plain values.
+    """
+    dat = open_file(path)
+    try:
+        spectra, wl, power, bg = read_arrays(dat, path.split('.')[-1], data_var, wl_var, power_var, bg_var)
+        unused = unused_axes(spectra.shape, [wl, power])
+        summed = int(np.prod([spectra.shape[i] for i in unused]))
+        if sub_bg and bg is None:
+            raise Exception(f"No background \"{bg_var}\" in the file")
+        total = reduce_blocks(spectra, unused)
+        if sub_bg:
+            total = subtract_background(total, summed, bg)
+    finally:
+        if isinstance(dat, MatFile):
+            dat.close()
+    result = ll_analysis.peak_analysis(total, wl)
+    result["threshold"], result["slope"] = ll_analysis.lasing_threshold(power, total.sum(axis=1))
+    result.update(spectra=total, wl=wl, power=power, output=total.sum(axis=1))
+    return result
+
+
+class RecomputeGraph:
+    """
+    Cached intermediate results, each computed from the stages it depends on. Invalidating
+    a stage drops it and everything downstream of it, and :func:`get` recomputes only the
+    stages that are missing.
+    """
+    def __init__(self):
+        self._compute = {}
+        self._inputs = {}
+        self._values = {}
+
+    def add(self, name, compute, inputs=()):
+        self._compute[name] = compute
+        self._inputs[name] = list(inputs)
+
+    def has(self, name):
+        return name in self._values
+
+    def get(self, name):
+        if name not in self._values:
+            self._values[name] = self._compute[name](*[self.get(i) for i in self._inputs[name]])
+        return self._values[name]
+
+    def invalidate(self, name):
+        self._values.pop(name, None)
+        for other, inputs in self._inputs.items():
+            if name in inputs:
+                self.invalidate(other)
+
 
 class Piece(pzp.Piece):
     def __init__(self, puzzle, custom_horizontal=True, *args, **kwargs):
+        # raw arrays from the file -> summed over unused axes -> background subtracted -> normalised,
+        # so each toggle only redoes the stages after it. The peak analysis uses the spectra before
+        # normalising, so toggling "Normalise" keeps it
+        self._graph = RecomputeGraph()
+        self._graph.add("source", self._load_arrays)
+        self._graph.add("reduced", self._reduce, ["source"])
+        self._graph.add("subtracted", self._subtract, ["source", "reduced"])
+        self._graph.add("normalised", self._normalise, ["subtracted"])
+        self._graph.add("analysis", self._analyse, ["subtracted"])
         super().__init__(puzzle, custom_horizontal, *args, **kwargs)
         # Set horizontal layout stretch: 1/5 left (params), 4/5 right (plots)
         self.layout.setStretch(0, 1)
@@ -34,6 +242,13 @@ class Piece(pzp.Piece):
         pzp.param.checkbox(self, "Sub. BG", False, visible=True)(None)
         pzp.param.array(self, "Norm Spectra", False)(None)
         pzp.param.slider(self, "Spectrum slider", 0, visible=True, v_step=1)(None)
+        # Peak, linewidth, side modes and lasing threshold of the whole dataset, see ll_analysis
+        pzp.param.checkbox(self, "Analyse", False, visible=True)(None)
+        pzp.param.dropdown(self, "Analysis plot", "Peak wavelength", visible=True)(None)
+        self["Analysis plot"].input.addItems(list(ANALYSIS_PLOTS))
+        pzp.param.readout(self, "Threshold", visible=True)(None)
+        for name in ANALYSIS_PLOTS:
+            pzp.param.array(self, name, False)(None)
 
         self["DATA var"].set_value("raw")
         self["WL var"].set_value("wl")
@@ -76,11 +291,11 @@ class Piece(pzp.Piece):
                         if self.old_POWERvar in axes: self["POWER var"].set_value(self.old_POWERvar)
                         if self.old_BGvar in self.dat.metadata.keys(): self["BG var"].set_value(self.old_BGvar)
                     case "mat":
-                        try:
-                            self.dat = loadmat(self.raw_filename)
-                        except:
-                            self.dat = mat73.loadmat(self.raw_filename)
-                        keys = list(self.dat.keys())
+                        # Only the variable names are read here, the data when it's compiled
+                        if isinstance(getattr(self, "dat", None), MatFile):
+                            self.dat.close()
+                        self.dat = MatFile(self.raw_filename)
+                        keys = self.dat.keys()
                         for k in ["DATA var","WL var","POWER var","BG var"]:
                             self[k].input.clear()
                             self[k].input.addItems(keys)
@@ -91,74 +306,113 @@ class Piece(pzp.Piece):
                         if self.old_BGvar in keys: self["BG var"].set_value(self.old_BGvar)
                     case _: raise Exception("File type invalid")
 
+        # --- Export action: contour plot of the map, as a figure file ---
+        @pzp.action.define(self, 'Export figure', visible=True)
+        def export_figure(self, filename=None):
+            if filename is None:
+                filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+                    None, 'Save figure as...', '', 'Images (*.png *.pdf *.svg)')
+            if filename:
+                figure = Figure(figsize=(6, 4.5))
+                self.contourGraph(figure)
+                figure.savefig(filename, dpi=300)
+
         # --- Compile action ---
         @pzp.action.define(self, 'Compile', visible=True)
         def compile(self):
-            # Load arrays based on datatype
-            match self["datatype"].value:
-                case "ds":
-                    self.spectra = self.dat.raw
-                    self["Wavelength"].set_value(self.dat.axis(self["WL var"].value))
-                    self["Power"].set_value(self.dat.axis(self["POWER var"].value))
-                    self['Background'].set_value(self.dat.metadata.get(self["BG var"].value))
-                    self["Spectrum slider"].input.input.setMaximum(self.dat.axis(self["POWER var"].value).size - 1)
-                case "mat":
-                    self.spectra = self.dat.get(self["DATA var"].value)
-                    self["Wavelength"].set_value(self.dat.get(self["WL var"].value).reshape(-1))
-                    self["Power"].set_value(self.dat.get(self["POWER var"].value).reshape(-1))
-                    self['Background'].set_value(self.dat.get(self["BG var"].value).reshape(-1))
-                    self["Spectrum slider"].input.input.setMaximum(self.dat.get(self["POWER var"].value).size - 1)
-                case _: raise Exception("File type invalid")
-
-            # Background subtraction if checked
-            if self["Sub. BG"].value:
-                self.spectra_subBG = self.spectra.astype(np.int32) - self['Background'].value[np.newaxis, ...]
-            else:
-                self.spectra_subBG = self.spectra
+            # Start again from the file, the selected variables may have changed
+            self._graph.invalidate("source")
+            self._update_spectra()
 
-            # Sum along unused axes
-            unused_axes = self.find_unused_axes(self.spectra, [self["Wavelength"].value, self["Power"].value])
-            self["Spectra"].set_value(
-                self.spectra_subBG.sum(axis=tuple(unused_axes)) if unused_axes else self.spectra_subBG
-            )
-            
-            self.normalize_spectra()
+    def _load_arrays(self):
+        # Load arrays based on datatype
+        self.spectra, wl, power, bg = read_arrays(self.dat, self["datatype"].value, self["DATA var"].value,
+                                                  self["WL var"].value, self["POWER var"].value, self["BG var"].value)
+        self["Wavelength"].set_value(wl)
+        self["Power"].set_value(power)
+        self['Background'].set_value(bg)
+        self["Spectrum slider"].input.input.setMaximum(power.size - 1)
+        return self.spectra
+
+    def _reduce(self, spectra):
+        # Sum along unused axes, a block at a time, and count the frames summed into each spectrum
+        unused_axes = self.find_unused_axes(spectra, [self["Wavelength"].value, self["Power"].value])
+        summed = int(np.prod([spectra.shape[i] for i in unused_axes]))
+        return reduce_blocks(spectra, unused_axes), summed
+
+    def _subtract(self, spectra, reduced):
+        total, summed = reduced
+        if self["Sub. BG"].value:
+            return subtract_background(total, summed, self['Background'].value)
+        return total
+
+    def _normalise(self, S):
+        # Normalize spectra to [0,1] along axis=1 if "Normalise" checked
+        if self["Normalise"].value:
+            return (S - S.min(axis=1)[...,np.newaxis]) / (S.max(axis=1)[...,np.newaxis]-S.min(axis=1)[...,np.newaxis])
+        return S
+
+    def _update_spectra(self):
+        self["Spectra"].set_value(self._graph.get("subtracted"))
+        self["Norm Spectra"].set_value(self._graph.get("normalised"))
+
+    def _analyse(self, spectra):
+        # Every spectrum at once, and the threshold of the summed output against power
+        result = ll_analysis.peak_analysis(spectra, self["Wavelength"].value)
+        result["threshold"], result["slope"] = ll_analysis.lasing_threshold(self["Power"].value, spectra.sum(axis=1))
+        return result
+
+    def _update_analysis(self):
+        result = self._graph.get("analysis")
+        for name, key in ANALYSIS_PLOTS.items():
+            self[name].set_value(result[key])
+        self["Threshold"].set_value(result["threshold"])
+        return result
 
     def find_unused_axes(self, DATA, used_axe_list):
         # Return axes in DATA not covered by Wavelength/Power
-        used_sizes = {ax.size for ax in used_axe_list}
-        return [i for i, size in enumerate(DATA.shape) if size not in used_sizes]
+        return unused_axes(DATA.shape, used_axe_list)
 
     def normalize_spectra(self):
-        # Normalize spectra to [0,1] along axis=1 if "Normalise" checked
-        if self["Normalise"].value:
-            S = self["Spectra"].value
-            self["Norm Spectra"].set_value((S - S.min(axis=1)[...,np.newaxis]) / (S.max(axis=1)[...,np.newaxis]-S.min(axis=1)[...,np.newaxis]))
-        else:
-            self["Norm Spectra"].set_value(self["Spectra"].value)
+        self._graph.invalidate("normalised")
+        self["Norm Spectra"].set_value(self._graph.get("normalised"))
 
-    def contourGraph(self):
-        # Draw contour plot of normalized spectra
-        self.figure.clear()
-        ax = self.figure.add_subplot(1,1,1)
+    def contourGraph(self, figure):
+        # Draw contour plot of normalized spectra, for exported figures
+        figure.clear()
+        ax = figure.add_subplot(1,1,1)
         XX, YY = np.meshgrid(self["Wavelength"].value, self["Power"].value)
-        ax.contourf(XX, YY, self["Norm Spectra"].value, levels=50)
+        contour = ax.contourf(XX, YY, self["Norm Spectra"].value, levels=50)
+        figure.colorbar(contour, ax=ax)
         ax.set_xlabel("Wavelength")
         ax.set_ylabel("Power")
         ax.set_title("Norm. intensity" if self["Normalise"].value else "Intensity")
-        self.figure.tight_layout()
-        self.canvas.draw()
+        figure.tight_layout()
+
+    def mapGraph(self):
+        # Draw the normalized spectra as an image over the wavelength and power axes
+        image, rect = self._grid.resample(self["Norm Spectra"].value, self["Wavelength"].value, self["Power"].value)
+        self.map_image.setImage(image, autoLevels=True)
+        self.map_image.setRect(rect)
+        self.map_plot.setTitle("Norm. intensity" if self["Normalise"].value else "Intensity")
 
     def custom_layout(self):
         # Custom layout: Matplotlib figure + toolbar + PyQtGraph plots
         layout = QtWidgets.QGridLayout()
 
-        # --- Matplotlib ---
-        self.figure = Figure()
-        self.canvas = FigureCanvas(self.figure)
-        self.toolbar = NavigationToolbar(self.canvas)
-        layout.addWidget(self.toolbar, 0, 0, 1, 2)
-        layout.addWidget(self.canvas, 1, 0, 1, 2)
+        # --- Map (matplotlib is only used for "Export figure") ---
+        self._grid = display_tools.UniformGrid()
+        self.map_widget = pg.GraphicsLayoutWidget()
+        layout.addWidget(self.map_widget, 0, 0, 2, 2)
+        self.map_plot = self.map_widget.addPlot(0, 0)
+        self.map_plot.setLabel('left', 'Power')
+        self.map_plot.setLabel('bottom', 'Wavelength')
+        self.map_image = pg.ImageItem(axisOrder='row-major')
+        self.map_image.setColorMap(pg.colormap.get("viridis"))
+        self.map_plot.addItem(self.map_image)
+        # Power of the spectrum shown below
+        slice_line = pg.InfiniteLine(0, 0, pen=(255, 255, 255, 120))
+        self.map_plot.addItem(slice_line)
 
         # --- PyQtGraph ---
         self.pw = pg.GraphicsLayoutWidget()
@@ -170,6 +424,8 @@ class Piece(pzp.Piece):
         max_plot.setLabel('left', 'Max. counts')
         max_plot.setLabel('bottom', 'Power')
         max_line = max_plot.plot([0],[0])
+        threshold_line = pg.InfiniteLine(0, 90, pen=(255, 100, 100, 150))
+        max_plot.addItem(threshold_line)
         
         spectrum_plot = self.pw.addPlot(0,1)
         spectrum_plot.showGrid(True, True)
@@ -177,13 +433,42 @@ class Piece(pzp.Piece):
         spectrum_plot.setLabel('bottom', 'Wavelength')
         slide_spectrum = spectrum_plot.plot([0],[0])
 
+        analysis_plot = self.pw.addPlot(1,0,1,2)
+        analysis_plot.showGrid(True, True)
+        analysis_plot.setLabel('bottom', 'Power')
+        analysis_line = analysis_plot.plot([0],[0], symbol='o', symbolSize=4)
+        # Peak wavelength traced over the map
+        peak_line = self.map_plot.plot([], [], pen=(255, 100, 100, 200))
+
         # --- Update helpers ---
         def draw_max_line(): max_line.setData(self["Power"].value, self["Spectra"].value.sum(axis=1))
-        def draw_slice_spectrum(): slide_spectrum.setData(self["Wavelength"].value, self["Norm Spectra"].value[self["Spectrum slider"].value,:])
-        def update_plots(): self.contourGraph(); draw_max_line(); draw_slice_spectrum()
-        def update_norm(): self.normalize_spectra(); update_plots()
-        def update_bgsub(): self.actions["Compile"]()
-        def update_log(): max_plot.setLogMode(self["Log scale"].value, self["Log scale"].value)
+        def draw_slice_spectrum():
+            slide_spectrum.setData(self["Wavelength"].value, self["Norm Spectra"].value[self["Spectrum slider"].value,:])
+            slice_line.setValue(self["Power"].value[self["Spectrum slider"].value])
+        def draw_analysis():
+            shown = self["Analyse"].value and self._graph.has("subtracted")
+            threshold_line.setVisible(bool(shown))
+            analysis_plot.setVisible(bool(shown))
+            if not shown:
+                peak_line.setData([], [])
+                return
+            result = self._update_analysis()
+            name = self["Analysis plot"].value
+            analysis_plot.setLabel('left', name)
+            # SMSR is infinite without side modes, leave those points out
+            values = np.where(np.isfinite(self[name].value), self[name].value, np.nan)
+            analysis_line.setData(self["Power"].value, values, connect="finite")
+            peak_line.setData(result["wavelength"], self["Power"].value)
+            # The L-I plot is drawn against log10(power) in log scale
+            threshold = result["threshold"]
+            threshold_line.setValue(np.log10(threshold) if self["Log scale"].value and threshold > 0 else threshold)
+        def update_plots(): self.mapGraph(); draw_max_line(); draw_slice_spectrum(); draw_analysis()
+        def update_norm():
+            if self._graph.has("subtracted"): self.normalize_spectra(); update_plots()
+        def update_bgsub():
+            # Only the subtraction and normalisation are redone, not the loading and summing
+            if self._graph.has("reduced"): self._graph.invalidate("subtracted"); self._update_spectra(); update_plots()
+        def update_log(): max_plot.setLogMode(self["Log scale"].value, self["Log scale"].value); draw_analysis()
         def update_spectrum(): draw_slice_spectrum()
 
         # Connect param changes to plot updates
@@ -192,12 +477,184 @@ class Piece(pzp.Piece):
         self["Sub. BG"].changed.connect(update_bgsub)
         self["Log scale"].changed.connect(update_log)
         self["Spectrum slider"].changed.connect(update_spectrum)
+        self["Analyse"].changed.connect(draw_analysis)
+        self["Analysis plot"].changed.connect(draw_analysis)
+        draw_analysis()
         
         return layout
 
+
+class Batch(pzp.Piece):
+    """
+    Compares many LL files at once. Files are compiled (loaded, summed, background subtracted
+    and analysed) in parallel on a pool of "workers" processes, so the window stays responsive,
+    and each result is cached by path, modification time and settings, so adding files again or
+    switching the settings back only compiles what changed. The chosen quantity is overlaid for
+    all files, with their lasing thresholds side by side.
+    """
+    def __init__(self, puzzle, custom_horizontal=True, *args, **kwargs):
+        self._paths = []
+        # path -> cache key of its latest submission, key -> Future or compiled result
+        self._keys = {}
+        self._futures = {}
+        self._cache = collections.OrderedDict()
+        self._failed = {}
+        self._pool = None
+        self._pool_workers = None
+        super().__init__(puzzle, custom_horizontal, *args, **kwargs)
+
+    def define_params(self):
+        pzp.param.spinbox(self, "workers", max(1, (os.cpu_count() or 2) // 2), v_min=1, v_max=64)(None)
+        pzp.param.text(self, "DATA var", "raw")(None)
+        pzp.param.text(self, "WL var", "wl")(None)
+        pzp.param.text(self, "POWER var", "aom_voltage")(None)
+        pzp.param.text(self, "BG var", "background")(None)
+        pzp.param.checkbox(self, "Sub. BG", False)(None)
+        pzp.param.dropdown(self, "Overlay", "L-I")(None)
+        self["Overlay"].input.addItems(["L-I", *ANALYSIS_PLOTS])
+        pzp.param.checkbox(self, "Log scale", False)(None)
+        # Compiled files kept in memory, each is the size of its summed spectra
+        pzp.param.spinbox(self, "cache size", 32, v_min=1, visible=False)(None)
+
+        @pzp.param.readout(self, "files")
+        def files(self):
+            return len(self._paths)
+
+        @pzp.param.readout(self, "pending")
+        def pending(self):
+            return len(self._futures)
+
+    def define_actions(self):
+        @pzp.action.define(self, "Add files")
+        def add_files(self, paths=None):
+            if paths is None:
+                paths, _ = QtWidgets.QFileDialog.getOpenFileNames(
+                    None, 'Open LL data', '', 'LL data (*.ds *.mat);;dataset data (*.ds);;MATLAB data (*.mat)')
+            self._paths += [path for path in paths if path not in self._paths]
+            self._submit()
+
+        @pzp.action.define(self, "Clear")
+        def clear(self):
+            # Compiled results stay cached for when the files are added again
+            self._paths = []
+            self._failed = {}
+            self._collect()
+
+        @pzp.action.define(self, "Save thresholds")
+        def save_thresholds(self, filename=None):
+            if filename is None:
+                filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+                    None, 'Save thresholds', '', 'CSV (*.csv)')
+            if filename:
+                with open(filename, "w") as f:
+                    f.write("file,threshold,slope\n")
+                    for path, result in self._results():
+                        f.write(f"{path},{result['threshold']},{result['slope']}\n")
+
+    def _settings(self):
+        return tuple(self[name].value for name in ("DATA var", "WL var", "POWER var", "BG var", "Sub. BG"))
+
+    def _submit(self):
+        # Start compiling the files that have no result for the current settings yet
+        settings = self._settings()
+        if self._pool is None or self._pool_workers != self["workers"].value:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool_workers = self["workers"].value
+            self._pool = concurrent.futures.ProcessPoolExecutor(self._pool_workers)
+        for path in self._paths:
+            key = (os.path.abspath(path), os.path.getmtime(path), *settings)
+            self._keys[path] = key
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            elif key not in self._futures:
+                self._failed.pop(path, None)
+                self._futures[key] = self._pool.submit(compile_file, path, *settings)
+        self._collect()
+        if self._futures:
+            self._poll.start()
+
+    def _collect(self):
+        # Timer function: take in finished files and redraw, raising any errors at the end
+        errors = []
+        for key, future in list(self._futures.items()):
+            if not future.done():
+                continue
+            del self._futures[key]
+            try:
+                self._cache[key] = future.result()
+            except Exception as e:
+                path = next((p for p, k in self._keys.items() if k == key), key[0])
+                self._failed[path] = e
+                errors.append(f"{os.path.basename(path)}: {e}")
+        while len(self._cache) > self["cache size"].value:
+            self._cache.popitem(last=False)
+        if not self._futures:
+            self._poll.stop()
+        self["files"].get_value()
+        self["pending"].get_value()
+        self._draw()
+        if errors:
+            raise Exception("Could not compile " + "; ".join(errors))
+
+    def _results(self):
+        # (path, result) of the files compiled with their current settings, in the order added
+        return [(path, self._cache[self._keys[path]]) for path in self._paths
+                if self._keys.get(path) in self._cache]
+
+    def _draw(self):
+        overlay = self["Overlay"].value
+        self.overlay_plot.clear()
+        self.overlay_plot.setLabel('left', overlay)
+        results = self._results()
+        names = []
+        for i, (path, result) in enumerate(results):
+            y = result["output"] if overlay == "L-I" else result[ANALYSIS_PLOTS[overlay]]
+            y = np.where(np.isfinite(y), y, np.nan)
+            names.append(os.path.basename(path))
+            self.overlay_plot.plot(result["power"], y, pen=pg.intColor(i, len(results)),
+                                   name=names[-1], connect="finite")
+        self.threshold_bars.setOpts(x=np.arange(len(results)), height=[r["threshold"] for p, r in results],
+                                    brushes=[pg.intColor(i, len(results)) for i in range(len(results))])
+        self.threshold_plot.getAxis('bottom').setTicks([list(enumerate(names))])
+
+    def custom_layout(self):
+        layout = QtWidgets.QVBoxLayout()
+
+        self.pw = pg.GraphicsLayoutWidget()
+        layout.addWidget(self.pw)
+        self.overlay_plot = self.pw.addPlot(0, 0)
+        self.overlay_plot.showGrid(True, True)
+        self.overlay_plot.setLabel('bottom', 'Power')
+        self.overlay_plot.addLegend()
+        self.threshold_plot = self.pw.addPlot(1, 0)
+        self.threshold_plot.showGrid(False, True)
+        self.threshold_plot.setLabel('left', 'Threshold')
+        self.threshold_bars = pg.BarGraphItem(x=[], height=[], width=0.6)
+        self.threshold_plot.addItem(self.threshold_bars)
+
+        # Finished files are picked up on the GUI thread
+        self._poll = QtCore.QTimer(self)
+        self._poll.setInterval(100)
+        self._poll.timeout.connect(self._collect)
+
+        def update_log(): self.overlay_plot.setLogMode(False, self["Log scale"].value)
+        self["Overlay"].changed.connect(self._draw)
+        self["Log scale"].changed.connect(update_log)
+        for name in ("DATA var", "WL var", "POWER var", "BG var", "Sub. BG"):
+            self[name].changed.connect(self._submit)
+        return layout
+
+    def handle_close(self, event):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
 if __name__ == "__main__":
     app = pzp.QApp([])
     puzzle = pzp.Puzzle(app, "LL viewer", debug=False)
-    puzzle.add_piece("ll_viewer", Piece(puzzle), 0, 0)
+    folder = puzzle.add_folder(0, 0)
+    folder.add_piece("ll_viewer", Piece(puzzle))
+    folder.add_piece("batch", Batch(puzzle))
     puzzle.show()
     app.exec()
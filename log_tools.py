@@ -0,0 +1,173 @@
+import numpy as np
+import threading
+import time
+import os
+import io
+import glob
+
+# Fixed-memory logging of readout values (power, temperature, counts) over multi-day runs,
+# used by the Logger piece.
+
+
+class DecimatedSeries:
+    """
+    Time series of one value in fixed memory. The newest `capacity` samples are kept as they
+    are, and each of `levels` coarser rings keeps `capacity` blocks of (time, min, max, mean)
+    over `factor` entries of the level below. With the defaults, one sample a second is
+    kept raw for almost three hours and as blocks for years, in under 2 MB.
+
+    :func:`window` picks the finest level that spans the requested time in at most
+    `max_points` points, so plotting the last week costs the same as the last minute.
+    Samples not yet written to disk are returned by :func:`flush`.
+    """
+
+    def __init__(self, capacity=10000, factor=10, levels=5):
+        self.capacity = int(capacity)
+        self.factor = int(factor)
+        # Rows of (time, min, max, mean); level 0 holds samples, so min = max = mean
+        self._rings = [np.full((self.capacity, 4), np.nan) for i in range(levels + 1)]
+        self._counts = [0] * (levels + 1)
+        # Time of the last sample that went into each level
+        self._ends = [-np.inf] * (levels + 1)
+        # Block being gathered for each coarser level: [time sum, min, max, sum, n, end time]
+        self._pending = [None] * (levels + 1)
+        self._flushed = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._counts[0]
+
+    def append(self, t, value):
+        if not np.isfinite(value):
+            return
+        with self._lock:
+            self._push(0, (t, value, value, value), t)
+
+    def _push(self, level, row, end):
+        self._rings[level][self._counts[level] % self.capacity] = row
+        self._counts[level] += 1
+        self._ends[level] = end
+        if level + 1 == len(self._rings):
+            return
+        t, low, high, mean = row
+        block = self._pending[level + 1]
+        if block is None:
+            block = self._pending[level + 1] = [0., low, high, 0., 0, end]
+        block[0] += t
+        block[1] = min(block[1], low)
+        block[2] = max(block[2], high)
+        block[3] += mean
+        block[4] += 1
+        block[5] = end
+        if block[4] == self.factor:
+            self._pending[level + 1] = None
+            self._push(level + 1, (block[0] / self.factor, block[1], block[2], block[3] / self.factor), block[5])
+
+    def _ordered(self, level):
+        count, ring = self._counts[level], self._rings[level]
+        if count <= self.capacity:
+            return ring[:count]
+        start = count % self.capacity
+        return np.concatenate((ring[start:], ring[:start]))
+
+    def window(self, span, now=None, max_points=2000):
+        """
+        Rows of (time, min, max, mean) for the last `span` seconds before `now` (the
+        newest sample by default), oldest first.
+        """
+        with self._lock:
+            if not self._counts[0]:
+                return np.empty((0, 4))
+            now = self._ends[0] if now is None else now
+            start = now - span
+            # Finest level that reaches back far enough without too many points
+            for level in range(len(self._rings)):
+                rows = self._ordered(level)
+                covers = self._counts[level] <= self.capacity or rows[0, 0] <= start
+                if covers and np.count_nonzero(rows[:, 0] >= start) <= max_points:
+                    break
+            # The newest samples are still in the blocks being gathered, take them from finer levels
+            parts = [rows[rows[:, 0] >= start]]
+            for finer in range(level - 1, -1, -1):
+                rows = self._ordered(finer)
+                parts.append(rows[(rows[:, 0] > self._ends[finer + 1]) & (rows[:, 0] >= start)])
+            return np.concatenate(parts)
+
+    def unflushed(self):
+        # Samples appended since the last flush, at most `capacity` of them can still be flushed
+        return self._counts[0] - self._flushed
+
+    def flush(self):
+        """
+        Samples appended since the last flush as arrays of times and values. Samples that
+        were pushed out of the raw ring before being flushed are lost, so flush before
+        :func:`unflushed` reaches `capacity`.
+        """
+        with self._lock:
+            count = self._counts[0]
+            new = min(count - self._flushed, self.capacity)
+            rows = self._ordered(0)[-new:] if new else np.empty((0, 4))
+            self._flushed = count
+            return rows[:, 0].copy(), rows[:, 3].copy()
+
+
+def write_chunk(folder, name, times, values):
+    """
+    Save the flushed samples of one series as a compressed chunk
+    ``<folder>/<name>_<start time>.npz`` and return its path, or None if there is nothing
+    to save. The file is written whole under a temporary name first. The start time is to
+    the millisecond, with a count added if a chunk already starts then, so fast flushes
+    don't write over each other.
+    """
+    if not len(times):
+        return None
+    os.makedirs(folder, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(times[0])) + f".{int(times[0] * 1e3) % 1000:03d}"
+    path = os.path.join(folder, f"{safe_name(name)}_{stamp}.npz")
+    i = 0
+    while os.path.exists(path):
+        i += 1
+        path = os.path.join(folder, f"{safe_name(name)}_{stamp}-{i:03d}.npz")
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, time=times, value=values)
+    with open(path + ".tmp", "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def read_chunks(folder, name):
+    """
+    Times and values of all the chunks saved for a series, oldest first.
+    """
+    times, values = [], []
+    for path in sorted(glob.glob(os.path.join(folder, f"{safe_name(name)}_*.npz"))):
+        with np.load(path) as chunk:
+            times.append(chunk["time"])
+            values.append(chunk["value"])
+    if not times:
+        return np.empty(0), np.empty(0)
+    times, values = np.concatenate(times), np.concatenate(values)
+    order = np.argsort(times, kind="stable")
+    return times[order], values[order]
+
+
+def safe_name(name):
+    # Readout names are "piece:param", which is not allowed in Windows file names
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+if __name__ == "__main__":
+    # A week of one sample a second, then windows of the last minute to the whole week
+    series = DecimatedSeries()
+    t0 = time.time()
+    week = 7 * 24 * 3600
+    t = time.perf_counter()
+    for i in range(week):
+        series.append(t0 + i, np.sin(i / 3600))
+    print(f"Appended {week} samples in {time.perf_counter() - t:.1f} s, "
+          f"{sum(r.nbytes for r in series._rings) / 1e6:.1f} MB held")
+    for label, span in (("minute", 60), ("hour", 3600), ("day", 86400), ("week", week)):
+        t = time.perf_counter()
+        rows = series.window(span)
+        print(f"Last {label:6s} {len(rows):5d} points in {(time.perf_counter() - t)*1e3:.2f} ms")